@@ -0,0 +1,43 @@
+"""
+compare the running time of the equivalent group size algorithms on synthetic data with missing values
+
+the first case draws the missing values independently in every column,
+the second case is a large lattice, every subset of the first lattice_columns columns is a missing pattern,
+which is the case lattice_dp is meant for, the dict algorithm is skipped there as it is too slow
+
+usage: python benchmark_groupsize.py [rows] [columns] [missing rate] [lattice rows] [lattice columns]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from reidrisk.groupsize import DataFrameWithMissingValues
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+cols = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+missing_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+lattice_rows = int(sys.argv[4]) if len(sys.argv) > 4 else 50000
+lattice_cols = int(sys.argv[5]) if len(sys.argv) > 5 else 12
+
+
+def run(name, df, algorithms):
+    results = {}
+    for algorithm in algorithms:
+        dm = DataFrameWithMissingValues(df, [0])
+        start = time.perf_counter()
+        results[algorithm] = np.asarray(dm.get_equivalent_group_size(algorithm=algorithm))
+        print(name, algorithm, 'patterns:', dm.missing_patterns.unique_patterns.shape[0],
+              'seconds: %.3f' % (time.perf_counter() - start))
+    for algorithm in algorithms[1:]:
+        if not np.array_equal(results[algorithms[0]], results[algorithm]):
+            raise ValueError(algorithm + ' does not match the ' + algorithms[0] + ' algorithm')
+
+
+rng = np.random.default_rng(0)
+values = rng.integers(1, 6, size=(rows, cols))
+values[rng.random((rows, cols)) < missing_rate] = 0
+run('random', pd.DataFrame(values), ['dict', 'vectorized', 'lattice_dp'])
+
+values = rng.integers(1, 6, size=(lattice_rows, lattice_cols + 2))
+values[:, :lattice_cols][rng.random((lattice_rows, lattice_cols)) < 0.5] = 0
+run('lattice', pd.DataFrame(values), ['vectorized', 'lattice_dp'])
@@ -5,7 +5,10 @@ last modified: October 9, 2022
 This module contains the functions to creating the probabilistic attacker model for re-identification attack.
 
 """
-from typing import Dict, Hashable
+from collections import OrderedDict
+import hashlib
+import json
+import os
 
 import pandas as pd
 import numpy as np
@@ -13,15 +16,19 @@ import csv
 from .utils import generate_all_binary_string
 
 
-def joined_prob(fields_list, prob_list):
+def joined_prob(fields_list, prob_list, factorized=False):
     """
     :param fields_list: a list of fields, ['race', 'gender, age'], an item
     in the list can contain multiple fields
     :param prob_list: a list of probabilities
     :param all_fields: a list of all fields
+    :param factorized: if True, return a FactorizedProbModel that keeps the independent probabilities
+    instead of enumerating all the combinations
     :return: a list of joined probabilities, each probability is the joined probability
     that of each combinations of the fields in fields_list
     """
+    if factorized:
+        return factorized_joined_prob(fields_list, prob_list)
 
     """
     create a binary matrix to represent all the combinations of the fields
@@ -61,8 +68,195 @@ def joined_prob(fields_list, prob_list):
     return ProbModel(all_fields, all_fields_array, joined_prob_list)
 
 
+def factorized_joined_prob(fields_list, prob_list):
+    """
+    the same model as joined_prob, stored as one independent factor per item in fields_list
+    :return: a FactorizedProbModel
+    """
+    field_index_dict = {}
+    for i in range(len(fields_list)):
+        for item in fields_list[i].split(','):
+            field_index_dict[item] = i
+    all_fields = list(field_index_dict.keys())
+    factor_fields = [[] for _ in fields_list]
+    for field_i, field in enumerate(all_fields):
+        factor_fields[field_index_dict[field]].append(field_i)
+    return FactorizedProbModel(all_fields, factor_fields, prob_list)
+
+
+class FactorizedProbModel:
+    def __init__(self, all_fields, factor_fields, factor_probs):
+        """
+        the attacker model as independent factors, factor i reveals the fields
+        in factor_fields[i] with the probability factor_probs[i]
+        the combinations are only enumerated when they are asked for,
+        and the combinations with zero probability are never enumerated
+
+        :param all_fields: a list of fields
+        :param factor_fields: a list of lists of indexes into all_fields, one list per factor
+        :param factor_probs: the probability of each factor
+        """
+        if len(factor_fields) != len(factor_probs):
+            raise Exception("The number of factors is not equal to the length of factor_probs")
+        self.fields = list(all_fields)
+        self.factor_fields = [list(f) for f in factor_fields]
+        self.factor_probs = np.asarray(factor_probs, dtype=float)
+        if np.any(self.factor_probs < 0) or np.any(self.factor_probs > 1):
+            raise ValueError("The probabilities of the factors should be between 0 and 1")
+        # factor_matrix[i, j] is 1 if factor i reveals field j
+        self.factor_matrix = np.zeros((len(self.factor_fields), len(self.fields)), dtype=np.uint8)
+        for i, f in enumerate(self.factor_fields):
+            self.factor_matrix[i, f] = 1
+        self._expanded = None
+        self._content_hash = None
+
+    @property
+    def uncertain_factors(self):
+        return np.flatnonzero((self.factor_probs > 0) & (self.factor_probs < 1))
+
+    @property
+    def certain_fields_array(self):
+        """
+        the fields revealed by the factors with probability 1
+        """
+        return (self.factor_matrix[self.factor_probs == 1].sum(axis=0) > 0).astype(int)
+
+    def content_hash(self):
+        """
+        a hash of the fields, the fields of each factor and the probabilities of the factors,
+        it is computed once, so the model should not be modified after it is hashed
+        """
+        if self._content_hash is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(b'factorized')
+            h.update(repr(list(self.fields)).encode())
+            h.update(repr(self.factor_fields).encode())
+            h.update(np.ascontiguousarray(self.factor_probs, dtype=np.float64).tobytes())
+            self._content_hash = h.hexdigest()
+        return self._content_hash
+
+    def __len__(self):
+        """
+        the number of combinations with nonzero probability
+        """
+        return 2 ** len(self.uncertain_factors)
+
+    def field_marginals(self):
+        """
+        :return: np.ndarray, the probability that each field is known, computed from the factors directly
+        """
+        return 1 - np.prod(np.where(self.factor_matrix == 1, 1 - self.factor_probs[:, None], 1), axis=0)
+
+    def iter_combinations(self, chunk_size=4096):
+        """
+        enumerate the combinations with nonzero probability in chunks,
+        in the same order as the rows of joined_prob
+        :return: a generator of (fields_array, prob_list)
+        """
+        uncertain = self.uncertain_factors
+        certain = self.certain_fields_array
+        p = self.factor_probs[uncertain]
+        u_matrix = self.factor_matrix[uncertain].astype(int)
+        shifts = np.arange(len(uncertain))
+        for start in range(0, len(self), chunk_size):
+            index = np.arange(start, min(start + chunk_size, len(self)))
+            bits = (index[:, None] >> shifts) & 1
+            prob_list = np.prod(np.where(bits == 1, p, 1 - p), axis=1)
+            fields_array = ((bits @ u_matrix + certain) > 0).astype(int)
+            yield fields_array, prob_list
+
+    def expand(self):
+        """
+        :return: the ProbModel with all the combinations that have nonzero probability
+        """
+        if self._expanded is None:
+            chunks = list(self.iter_combinations())
+            self._expanded = ProbModel(self.fields, np.concatenate([c[0] for c in chunks]),
+                                       np.concatenate([c[1] for c in chunks]))
+        return self._expanded
+
+    @property
+    def fields_array(self):
+        return self.expand().fields_array
+
+    @property
+    def prob_list(self):
+        return self.expand().prob_list
+
+    def __add__(self, other):
+        if other is None:
+            return self
+        if isinstance(other, FactorizedProbModel):
+            # the factors of both models are independent, so the sum keeps all of them
+            fields = self.fields + [f for f in other.fields if f not in self.fields]
+            other_factor_fields = [[fields.index(other.fields[j]) for j in f] for f in other.factor_fields]
+            return FactorizedProbModel(fields, self.factor_fields + other_factor_fields,
+                                       np.concatenate([self.factor_probs, other.factor_probs]))
+        return add_two_prob_model(self.expand(), other)
+
+    def __radd__(self, other):
+        if other is None:
+            return self
+        return add_two_prob_model(other, self.expand())
+
+    def __str__(self):
+        return str(self.expand())
+
+    def to_string(self):
+        return self.__str__()
+
+
+class PruningPolicy:
+    def __init__(self, epsilon=0.0, top_k=None):
+        """
+        the rule that drops the combinations with negligible probability from a ProbModel
+        :param epsilon: the combinations with probability below epsilon are dropped
+        :param top_k: at most top_k combinations with the highest probability are kept
+        """
+        if epsilon < 0:
+            raise ValueError("epsilon can not be negative")
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k should be at least 1")
+        self.epsilon = epsilon
+        self.top_k = top_k
+
+    def keep_index(self, prob_list):
+        """
+        :return: the sorted indexes of the combinations to keep
+        """
+        keep = np.flatnonzero(prob_list >= self.epsilon)
+        if self.top_k is not None and len(keep) > self.top_k:
+            top = np.argsort(-prob_list[keep], kind='stable')[:self.top_k]
+            keep = np.sort(keep[top])
+        return keep
+
+
+def prune_prob_model(model, pruning):
+    """
+    :param model: a ProbModel object
+    :param pruning: a PruningPolicy object, or None to keep all the combinations
+    :return: a ProbModel object without the pruned combinations, the pruned probability
+    is added to its discarded_mass
+    """
+    if pruning is None:
+        return model
+    prob_list = np.asarray(model.prob_list, dtype=float)
+    keep = pruning.keep_index(prob_list)
+    if len(keep) == len(prob_list):
+        return model
+    if len(keep) == 0:
+        raise ValueError("the pruning policy drops all the combinations")
+    discarded = getattr(model, 'discarded_mass', 0.0) + prob_list.sum() - prob_list[keep].sum()
+    return ProbModel(model.fields, np.asarray(model.fields_array)[keep], prob_list[keep], discarded)
+
+
 class ProbModel:
-    def __init__(self, all_fields, fields_array, prob_list):
+    def __init__(self, all_fields, fields_array, prob_list, discarded_mass=0.0):
+        """
+        :param discarded_mass: the probability of the combinations that were pruned from the model,
+        a risk that is a probability-weighted average of values between 0 and 1
+        is off by at most discarded_mass
+        """
         # check if the length of all_fields is equal to the number of columsn in fields_array
         if len(all_fields) != len(fields_array[0]):
             raise Exception("The length of all_fields is not equal to the number of columns in fields_array")
@@ -72,10 +266,37 @@ class ProbModel:
         self.fields = all_fields
         self.fields_array = fields_array
         self.prob_list = prob_list
+        self.discarded_mass = discarded_mass
+        self._content_hash = None
+
+    def content_hash(self):
+        """
+        a hash of the fields, the combinations and the probabilities of the model,
+        models with the same content have the same hash.
+        it is computed once, so the model should not be modified after it is hashed
+        """
+        if self._content_hash is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(repr(list(self.fields)).encode())
+            fields_array = np.ascontiguousarray(self.fields_array, dtype=np.int64)
+            h.update(repr(fields_array.shape).encode())
+            h.update(fields_array.tobytes())
+            h.update(np.ascontiguousarray(self.prob_list, dtype=np.float64).tobytes())
+            h.update(repr(float(self.discarded_mass)).encode())
+            self._content_hash = h.hexdigest()
+        return self._content_hash
 
     def __add__(self, other):
         return add_two_prob_model(self, other)
 
+    def to_bitmask(self, registry=None):
+        """
+        :param registry: the FieldRegistry of the masks, a new one by default,
+        pass the same registry, such as FIELD_REGISTRY, to models that are added or compared often
+        :return: the BitmaskProbModel of this model
+        """
+        return BitmaskProbModel.from_prob_model(self, registry)
+
     def __str__(self):
         df = pd.DataFrame(self.fields_array, columns=self.fields)
         df['prob'] = self.prob_list
@@ -84,69 +305,394 @@ class ProbModel:
     def to_string(self):
         return self.__str__()
 
-def add_two_prob_model(model1, model2):
+def _align_fields_array(model, fields):
+    """
+    :return: the fields_array of model with its columns moved to the positions of fields
     """
+    fields_array = np.zeros((len(model.prob_list), len(fields)), dtype=np.uint8)
+    for i, item in enumerate(model.fields):
+        fields_array[:, fields.index(item)] = model.fields_array[:, i]
+    return fields_array
+
+
+def fields_array_to_keys(fields_array):
+    """
+    encode each row of a 0/1 fields_array as an uint64 key, the first field is the most significant bit,
+    so the keys sort in the same order as the rows
+    """
+    n = fields_array.shape[1]
+    if n > 64:
+        raise ValueError("a key can hold at most 64 fields")
+    weights = np.uint64(1) << np.arange(n - 1, -1, -1, dtype=np.uint64)
+    return (fields_array.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+
+
+def keys_to_fields_array(keys, n):
+    """
+    the inverse of fields_array_to_keys
+    """
+    shifts = np.arange(n - 1, -1, -1, dtype=np.uint64)
+    return ((keys[:, None] >> shifts) & np.uint64(1)).astype(int)
+
+
+def _as_prob_model(model):
+    """
+    :return: the ProbModel of a BitmaskProbModel, the other models are returned as they are
+    """
+    if isinstance(model, BitmaskProbModel):
+        return model.to_prob_model()
+    return model
+
+
+def add_two_prob_model(model1, model2, pruning=None):
+    """
+    the fields known in the sum are the union of the fields known in model1 and in model2,
+    every pair of nonzero rows is combined with one broadcast OR over the rows encoded as bitmasks,
+    and the probabilities of the pairs that give the same fields are added up
     :param model1: a ProbModel object
     :param model2: a ProbModel object
+    :param pruning: a PruningPolicy object that is applied to the sum
     :return: a ProbModel object that is the sum of model1 and model2
     """
     if model1 is None:
-        return model2
+        return prune_prob_model(_as_prob_model(model2), pruning)
     if model2 is None:
-        return model1
-    fields = list(set(model1.fields + model2.fields))
+        return prune_prob_model(_as_prob_model(model1), pruning)
+    model1 = _as_prob_model(model1)
+    model2 = _as_prob_model(model2)
+    fields = list(model1.fields) + [item for item in model2.fields if item not in model1.fields]
     cols_count = len(fields)
-    fields_array1 = np.zeros((model1.fields_array.shape[0], cols_count)).astype(int)
-    fields_array2 = np.zeros((model2.fields_array.shape[0], cols_count)).astype(int)
 
-    for item in fields:
-        if item in model1.fields:
-            fields_array1[:, fields.index(item)] = model1.fields_array[:, model1.fields.index(item)]
-        if item in model2.fields:
-            fields_array2[:, fields.index(item)] = model2.fields_array[:, model2.fields.index(item)]
+    prob_list1 = np.asarray(model1.prob_list, dtype=float)
+    prob_list2 = np.asarray(model2.prob_list, dtype=float)
+    m1_nonzero_index = np.flatnonzero(prob_list1 > 0)
+    m2_nonzero_index = np.flatnonzero(prob_list2 > 0)
+    fields_array1 = _align_fields_array(model1, fields)[m1_nonzero_index]
+    fields_array2 = _align_fields_array(model2, fields)[m2_nonzero_index]
+    total_prob_v = np.outer(prob_list1[m1_nonzero_index], prob_list2[m2_nonzero_index]).ravel()
+
+    if cols_count <= 64:
+        keys1 = fields_array_to_keys(fields_array1)
+        keys2 = fields_array_to_keys(fields_array2)
+        total_keys = (keys1[:, None] | keys2[None, :]).ravel()
+        unique_keys, inverse = np.unique(total_keys, return_inverse=True)
+        field_array = keys_to_fields_array(unique_keys, cols_count)
+    else:
+        # the rows are packed into bytes, the first field is the highest bit of the first byte
+        bytes1 = np.packbits(fields_array1, axis=1)
+        bytes2 = np.packbits(fields_array2, axis=1)
+        total_bytes = (bytes1[:, None, :] | bytes2[None, :, :]).reshape(-1, bytes1.shape[1])
+        unique_bytes, inverse = np.unique(total_bytes, axis=0, return_inverse=True)
+        field_array = np.unpackbits(unique_bytes, axis=1, count=cols_count).astype(int)
+    prob_v = np.bincount(inverse.reshape(-1), weights=total_prob_v, minlength=field_array.shape[0])
+    # the pairs that involve a discarded combination of either model are discarded too
+    discarded = 1 - (1 - getattr(model1, 'discarded_mass', 0.0)) * (1 - getattr(model2, 'discarded_mass', 0.0))
+    return prune_prob_model(ProbModel(fields, field_array, prob_v, discarded), pruning)
+
+
+def sum_prob_models(model1, model2, pruning=None):
+    """
+    :return: model1 + model2, two FactorizedProbModel objects are summed by keeping the factors of both,
+    without enumerating the combinations, and their sum is not pruned,
+    the other models are summed by add_two_prob_model with pruning
+    """
+    factorized = (FactorizedProbModel, type(None))
+    if isinstance(model1, factorized) and isinstance(model2, factorized):
+        return model1 + model2
+    return add_two_prob_model(model1, model2, pruning)
+
+
+class ProbModelSumCache:
+    def __init__(self, maxsize=1024):
+        """
+        a LRU cache of the sums of pairs of ProbModel or FactorizedProbModel objects, keyed by their content hashes,
+        so the condition groups that share the same models are only summed once
+        :param maxsize: the largest number of sums kept
+        """
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, model1, model2, pruning=None):
+        """
+        :return: sum_prob_models(model1, model2, pruning), from the cache if it was computed before
+        """
+        model1 = _as_prob_model(model1)
+        model2 = _as_prob_model(model2)
+        if not hasattr(model1, 'content_hash') or not hasattr(model2, 'content_hash'):
+            return sum_prob_models(model1, model2, pruning)
+        pruning_key = None if pruning is None else (pruning.epsilon, pruning.top_k)
+        key = (model1.content_hash(), model2.content_hash(), pruning_key)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        model_sum = sum_prob_models(model1, model2, pruning)
+        if self.maxsize > 0:
+            self._cache[key] = model_sum
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return model_sum
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache), 'maxsize': self.maxsize}
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# the cache used by add_two_attacker_model and combine_attackers unless another one is given
+PROB_MODEL_SUM_CACHE = ProbModelSumCache()
+
+
+class FieldRegistry:
+    def __init__(self, fields=()):
+        """
+        assign every field name a bit in the uint64 keys of BitmaskProbModel,
+        field i is bit i, a registry can hold at most 64 fields
+        """
+        self.fields = []
+        self._bits = {}
+        for field in fields:
+            self.bit(field)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def bit(self, field):
+        """
+        :return: the bit of field, a new field is registered with the next free bit
+        """
+        if field not in self._bits:
+            if len(self.fields) == 64:
+                raise ValueError("a field registry can hold at most 64 fields")
+            self._bits[field] = len(self.fields)
+            self.fields.append(field)
+        return self._bits[field]
+
+    def mask(self, fields):
+        """
+        :return: the uint64 mask with the bits of fields set
+        """
+        mask = 0
+        for field in fields:
+            mask |= 1 << self.bit(field)
+        return np.uint64(mask)
+
+    def fields_of(self, mask):
+        mask = int(mask)
+        return [field for i, field in enumerate(self.fields) if (mask >> i) & 1]
 
-    m1_nonzero_index = np.where(model1.prob_list > 0)[0]
-    m2_nonzero_index = np.where(model2.prob_list > 0)[0]
 
-    m1_nonzero = model1.prob_list[m1_nonzero_index]
-    m2_nonzero = model2.prob_list[m2_nonzero_index]
+# a registry that models can share by passing it explicitly, its fields are never released,
+# so it holds at most 64 distinct fields over the whole process
+FIELD_REGISTRY = FieldRegistry()
 
-    m1_fields_array_nonzero = fields_array1[m1_nonzero_index, :]
-    m2_fields_array_nonzero = fields_array2[m2_nonzero_index, :]
 
-    fields_array_list = []
-    prob_v_list = []
-    # iterate through each row in m1_fields_array_nonzero
-    for i in range(m1_fields_array_nonzero.shape[0]):
-        curr_row = m1_fields_array_nonzero[i, :]
-        m1_curr_fields_array = np.tile(curr_row, (m2_fields_array_nonzero.shape[0], 1))
-        m1_curr_prob_v = np.tile(np.array(m1_nonzero[i]), m2_fields_array_nonzero.shape[0])
+def _reduce_masks(masks, prob_list):
+    """
+    add up the probabilities of the rows with the same mask
+    :return: (sorted unique masks, their probabilities)
+    """
+    unique_masks, inverse = np.unique(masks, return_inverse=True)
+    return unique_masks, np.bincount(inverse.reshape(-1), weights=prob_list, minlength=len(unique_masks))
 
-        curr_fields_array = m1_curr_fields_array | m2_fields_array_nonzero
-        curr_prob_v = m1_curr_prob_v * m2_nonzero
 
-        fields_array_list.append(curr_fields_array)
-        prob_v_list.append(curr_prob_v)
+class BitmaskProbModel:
+    def __init__(self, masks, prob_list, registry=None, discarded_mass=0.0):
+        """
+        a compact ProbModel, each combination of known fields is an uint64 mask over the fields in registry
+
+        :param masks: np.ndarray of uint64, one mask per combination
+        :param prob_list: np.ndarray of float64, the probability of each combination
+        :param registry: the FieldRegistry that maps the bits to the fields, a new empty one by default
+        :param discarded_mass: the probability of the combinations that were pruned, see ProbModel
+        """
+        self.masks = np.asarray(masks, dtype=np.uint64)
+        self.prob_list = np.asarray(prob_list, dtype=np.float64)
+        if len(self.masks) != len(self.prob_list):
+            raise Exception("The number of masks is not equal to the length of prob_list")
+        self.registry = FieldRegistry() if registry is None else registry
+        self.discarded_mass = discarded_mass
 
-    total_fields_array = np.concatenate(fields_array_list)
-    total_prob_v = np.concatenate(prob_v_list)
+    @classmethod
+    def from_prob_model(cls, model, registry=None):
+        """
+        :param registry: the FieldRegistry of the masks, a new one by default
+        """
+        registry = FieldRegistry() if registry is None else registry
+        bits = np.array([registry.bit(field) for field in model.fields], dtype=np.uint64)
+        fields_array = np.asarray(model.fields_array).astype(np.uint64)
+        masks = (fields_array << bits).sum(axis=1, dtype=np.uint64)
+        return cls(*_reduce_masks(masks, np.asarray(model.prob_list, dtype=np.float64)), registry,
+                   getattr(model, 'discarded_mass', 0.0))
 
-    total_array = np.concatenate([total_fields_array, total_prob_v.reshape(total_prob_v.shape[0], 1)], axis=1)
+    @property
+    def fields(self):
+        """
+        the fields that are known in at least one combination, in the order of the registry
+        """
+        return self.registry.fields_of(np.bitwise_or.reduce(self.masks) if len(self.masks) > 0 else 0)
 
-    total_df = pd.DataFrame(total_array, columns=fields + ['prob'])
-    # convert the columns in fields to int
-    for item in fields:
-        total_df[item] = total_df[item].astype(int)
+    @property
+    def nbytes(self):
+        return self.masks.nbytes + self.prob_list.nbytes
 
-    group_sum_df = total_df.groupby(fields).sum().reset_index()
+    def to_prob_model(self, fields=None):
+        """
+        :param fields: the fields of the ProbModel, all the fields known in this model by default
+        """
+        fields = self.fields if fields is None else fields
+        bits = np.array([self.registry.bit(field) for field in fields], dtype=np.uint64)
+        fields_array = ((self.masks[:, None] >> bits) & np.uint64(1)).astype(int)
+        return ProbModel(fields, fields_array.reshape(len(self.masks), len(fields)), self.prob_list,
+                         self.discarded_mass)
 
-    field_array = group_sum_df[fields].values
-    prob_v = group_sum_df['prob'].values
-    return ProbModel(fields, field_array, prob_v)
+    def __add__(self, other):
+        if other is None:
+            return self
+        if isinstance(other, BitmaskProbModel) and other.registry is not self.registry:
+            # move the masks of other to the registry of this model
+            other = other.to_prob_model()
+        if not isinstance(other, BitmaskProbModel):
+            other = BitmaskProbModel.from_prob_model(other, self.registry)
+        nonzero1 = self.prob_list > 0
+        nonzero2 = other.prob_list > 0
+        masks = (self.masks[nonzero1][:, None] | other.masks[nonzero2][None, :]).ravel()
+        prob_list = np.outer(self.prob_list[nonzero1], other.prob_list[nonzero2]).ravel()
+        discarded = 1 - (1 - self.discarded_mass) * (1 - getattr(other, 'discarded_mass', 0.0))
+        return BitmaskProbModel(*_reduce_masks(masks, prob_list), self.registry, discarded)
+
+    def marginalize(self, fields):
+        """
+        :return: the model over only the given fields, the other fields are treated as unknown
+        """
+        keep = self.registry.mask(fields)
+        return BitmaskProbModel(*_reduce_masks(self.masks & keep, self.prob_list), self.registry, self.discarded_mass)
+
+    def prob_known(self, fields):
+        """
+        :return: the probability that all the given fields are known
+        """
+        mask = self.registry.mask(fields)
+        return float(self.prob_list[(self.masks & mask) == mask].sum())
+
+    def lookup(self, fields):
+        """
+        :return: the probability that exactly the given fields are known
+        """
+        return float(self.prob_list[self.masks == self.registry.mask(fields)].sum())
+
+    def __str__(self):
+        return str(self.to_prob_model())
+
+    def to_string(self):
+        return self.__str__()
+
+
+class KnownFieldsTable:
+    def __init__(self, probability_df, condition_fields):
+        """
+        the rows of an attacker probability dataframe parsed once for all the condition groups,
+        the rows are sorted by condition group, and the known_fields of row i is row i of field_matrix
+
+        :param probability_df: the dataframe with the condition_fields, known_fields and probability columns
+        :param condition_fields: the list of condition fields
+        """
+        df = probability_df
+        if len(condition_fields) > 0:
+            grouped = df.groupby(condition_fields, sort=True)
+            group_ids = grouped.ngroup().to_numpy()
+            self.keys = [k if type(k) is tuple else tuple([k]) for k in grouped.size().index.tolist()]
+        else:
+            group_ids = np.zeros(len(df))
+            self.keys = [None]
+        # the rows with a missing condition value do not belong to any group
+        valid = np.flatnonzero(~np.isnan(group_ids.astype(float)))
+        group_ids = group_ids[valid].astype(np.int64)
+        order = valid[np.argsort(group_ids, kind='stable')]
+        self.group_ids = np.sort(group_ids, kind='stable')
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(self.group_ids, minlength=len(self.keys)))])
+        self.prob_list = df['probability'].to_numpy(dtype=float)[order]
+
+        split = df['known_fields'].iloc[order].astype(str).str.split(',')
+        items_count = split.str.len().to_numpy()
+        self.item_indptr = np.concatenate([[0], np.cumsum(items_count)])
+        self.item_row = np.repeat(np.arange(len(order)), items_count)
+        self.item_field, fields = pd.factorize(split.explode().to_numpy())
+        self.fields = list(fields)
+        self.field_matrix = np.zeros((len(order), len(self.fields)), dtype=bool)
+        self.field_matrix[self.item_row, self.item_field] = True
+
+    def check_overlap(self):
+        """
+        the known_fields of the rows in the same condition group should not overlap
+        """
+        if len(self.group_ids) == 0:
+            return
+        starts = self.indptr[:-1][np.diff(self.indptr) > 0]
+        counts = np.add.reduceat(self.field_matrix.astype(np.int64), starts, axis=0)
+        overlap = np.flatnonzero((counts > 1).any(axis=1))
+        if len(overlap) > 0:
+            name = self.keys[self.group_ids[starts[overlap[0]]]]
+            raise ValueError('ERROR in group' + str(
+                name) + ': The values in the known_fields in all the rows with the same values in the condition_fields should not overlap.')
+
+    def _group_fields(self, g):
+        """
+        :return: (the fields of group g in the order they appear, the index of the row of the group that knows each field)
+        """
+        start, end = self.indptr[g], self.indptr[g + 1]
+        items = slice(self.item_indptr[start], self.item_indptr[end])
+        field_codes = self.item_field[items]
+        rows = self.item_row[items] - start
+        field_index_dict = {}
+        for code, row in zip(field_codes, rows):
+            field_index_dict[code] = row
+        return [self.fields[code] for code in field_index_dict], list(field_index_dict.values())
+
+    def build_models(self, factorized=False, max_block=2**22):
+        """
+        build the ProbModel of every condition group, the same as joined_prob on each group,
+        the groups with the same number of rows share one binary table and are computed together
+
+        :return: a dictionary from the condition keys to the models,
+        or one model if there are no condition fields
+        """
+        sizes = np.diff(self.indptr)
+        models = {}
+        for r in np.unique(sizes):
+            groups = np.flatnonzero(sizes == r)
+            if factorized:
+                for g in groups:
+                    all_fields, factor_of_field = self._group_fields(g)
+                    factor_fields = [[i for i, f in enumerate(factor_of_field) if f == j] for j in range(r)]
+                    models[g] = FactorizedProbModel(all_fields, factor_fields,
+                                                    self.prob_list[self.indptr[g]:self.indptr[g + 1]])
+                continue
+            fields_array = generate_all_binary_string(r)
+            block = max(1, max_block // max(fields_array.size, 1))
+            for b in range(0, len(groups), block):
+                g_block = groups[b:b + block]
+                prob_vector = self.prob_list[self.indptr[g_block][:, None] + np.arange(r)]
+                prob_array = np.where(fields_array[None, :, :] == 1, prob_vector[:, None, :],
+                                      1 - prob_vector[:, None, :])
+                joined_prob_block = np.prod(prob_array, axis=2)
+                for i, g in enumerate(g_block):
+                    all_fields, factor_of_field = self._group_fields(g)
+                    models[g] = ProbModel(all_fields, fields_array[:, factor_of_field].astype(int),
+                                          joined_prob_block[i])
+        if self.keys == [None]:
+            return models[0]
+        return {self.keys[g]: models[g] for g in range(len(self.keys))}
 
 
 class Attacker:
-    def __init__(self, probability_df, model = None, name='',condition_fields=[]):
+    def __init__(self, probability_df, model = None, name='',condition_fields=[], factorized=False, flat_keys=False):
         """
         :param name: the name of the attacker
         :param condition_fields: the list of field names that the probabilities are conditioned on
@@ -160,9 +706,15 @@ class Attacker:
         For example, if row one and row two have the same values in all the columns corresponding to
         the condition_fields, and row one's known_fields is 'age, race', and row two's known_fields is 'age, gender'
         then the probability file is invalid.
+        :param factorized: if True, the models are FactorizedProbModel objects
+        :param flat_keys: True if the model keys of a combined attacker are flat tuples of the condition values
+        of all its attackers, as made by Attacker.combine, instead of nested pairs made by +
         """
         self.name = name
+        self.factorized = factorized
+        self.flat_keys = flat_keys
         self.probability_df = probability_df
+        self._known_fields_table = None
         self._check_columns()
         if condition_fields!=[]:
             self.condition_fields=condition_fields
@@ -183,31 +735,14 @@ class Attacker:
             if 'probability' not in header:
                 raise Exception("The column probability is not in the probability file")
 
+    def _get_known_fields_table(self):
+        if self._known_fields_table is None:
+            self._known_fields_table = KnownFieldsTable(self.probability_df, self.condition_fields)
+        return self._known_fields_table
+
     def _check_known_fields(self):
         if self.probability_df is not None:
-            df = self.probability_df
-            # group df by the condition_fields and check each group
-            if len(self.condition_fields) > 0:
-                for name, group in df.groupby(self.condition_fields):
-                    known_fields_list = group['known_fields'].tolist()
-                    known_fields_set = set()
-                    # check if the values in the known_fields are valid
-                    for i in known_fields_list:
-                        known_fields = set(i.split(','))
-                        # check if known_fields is in the known_fields_set
-                        if known_fields in known_fields_set:
-                            raise ValueError('ERROR in group' + str(
-                                name) + ': The values in the known_fields in all the rows with the same values in the condition_fields should not overlap.')
-            else:
-                known_fields_list = df['known_fields'].tolist()
-                known_fields_set = set()
-                # check if the values in the known_fields are valid
-                for i in known_fields_list:
-                    known_fields = set(i.split(','))
-                    # check if known_fields is in the known_fields_set
-                    if known_fields in known_fields_set:
-                        raise ValueError('ERROR in group' + str(
-                            name) + ': The values in the known_fields in all the rows with the same values in the condition_fields should not overlap.')
+            self._get_known_fields_table().check_overlap()
 
     def _get_condition_fields(self):
         if self.probability_df is not None:
@@ -224,26 +759,43 @@ class Attacker:
         and the values are ProbModel objects
         """
         if self.probability_df is not None:
-            df = self.probability_df
-            # group df by the condition_fields and check each group
-            attacker_model: dict[Hashable, ProbModel] = {}
-            if len(self.condition_fields) == 0:
-                known_fields_list = df['known_fields'].tolist()
-                prob_list = df['probability'].tolist()
-                attacker_model = joined_prob(known_fields_list, prob_list)
-            else:
-                for name, group in df.groupby(self.condition_fields):
-                    known_fields_list = group['known_fields'].tolist()
-                    prob_list = group['probability'].tolist()
-                    if type(name) is tuple:
-                        attacker_model[name] = joined_prob(known_fields_list, prob_list)
-                    else:
-                        attacker_model[tuple([name])] = joined_prob(known_fields_list, prob_list)
-            self.model = attacker_model
+            self.model = self._get_known_fields_table().build_models(self.factorized)
 
     def __add__(self, other):
         return add_two_attacker_model(self, other)
 
+    @property
+    def discarded_mass(self):
+        """
+        the largest probability pruned from the model of any condition group,
+        the risk reported for any record is off by at most this much
+        """
+        if self.model is None:
+            return 0.0
+        if isinstance(self.model, dict):
+            return max([getattr(m, 'discarded_mass', 0.0) for m in self.model.values()], default=0.0)
+        return getattr(self.model, 'discarded_mass', 0.0)
+
+    @staticmethod
+    def combine(attackers, pruning=None, name=None, cache=None):
+        """
+        combine several attackers at once, see combine_attackers
+        """
+        return combine_attackers(attackers, pruning, name, cache)
+
+    def save(self, path):
+        """
+        save the attacker to the directory path, see save_attacker
+        """
+        save_attacker(self, path)
+
+    @staticmethod
+    def load(path, mmap_mode='r', bitmask=False):
+        """
+        load an attacker saved by Attacker.save, see load_attacker
+        """
+        return load_attacker(path, mmap_mode, bitmask)
+
     def __str__(self):
         l1 = "Attacjer name: " + self.name + "\n"
         l2 = ''
@@ -256,12 +808,16 @@ class Attacker:
         return l1 + l2
 
 
-def add_two_attacker_model(model1, model2):
+def add_two_attacker_model(model1, model2, pruning=None, cache=None):
     '''
     :param model1: Attacker
     :param model2: Attacker
+    :param pruning: a PruningPolicy object that is applied to every summed ProbModel
+    :param cache: the ProbModelSumCache of the pairwise sums, PROB_MODEL_SUM_CACHE by default
     :return:
     '''
+    if cache is None:
+        cache = PROB_MODEL_SUM_CACHE
     m1 = model1.model
     m2 = model2.model
 
@@ -277,16 +833,241 @@ def add_two_attacker_model(model1, model2):
     model_sum = {}
     if len(model1.condition_fields) == 0:
         if len(model2.condition_fields) == 0:
-            model_sum = m1 + m2
+            model_sum = cache.add(m1, m2, pruning)
         else:
             for name2, group2 in m2.items():
-                model_sum[name2] = m1 + group2
+                model_sum[name2] = cache.add(m1, group2, pruning)
     else:
         if len(model2.condition_fields) == 0:
             for name1, group1 in m1.items():
-                model_sum[name1] = group1 + m2
+                model_sum[name1] = cache.add(group1, m2, pruning)
         else:
             for name1, group1 in m1.items():
                 for name2, group2 in m2.items():
-                    model_sum[tuple([name1, name2])] = group1 + group2
+                    model_sum[tuple([name1, name2])] = cache.add(group1, group2, pruning)
     return Attacker(None, model_sum,'',[model1.condition_fields, model2.condition_fields])
+
+
+def _flatten_condition_key(key):
+    """
+    turn the nested pairs of condition keys made by add_two_attacker_model into one flat tuple
+    """
+    if not isinstance(key, tuple):
+        return (key,)
+    flat = ()
+    for item in key:
+        flat += _flatten_condition_key(item)
+    return flat
+
+
+def _condition_field_leaves(condition_fields):
+    """
+    :return: the list of the condition fields of each single attacker in condition_fields
+    """
+    if all(type(item) is str for item in condition_fields):
+        return [list(condition_fields)]
+    leaves = []
+    for item in condition_fields:
+        leaves += _condition_field_leaves(item)
+    return leaves
+
+
+def _flat_models(attacker):
+    """
+    :return: a dictionary from the flat condition keys of attacker to its ProbModel objects
+    """
+    if isinstance(attacker.model, dict):
+        return {_flatten_condition_key(k): v for k, v in attacker.model.items()}
+    return {(): attacker.model}
+
+
+def combine_attackers(attackers, pruning=None, name=None, cache=None):
+    """
+    combine a list of attackers with one balanced-tree reduction instead of chaining +
+
+    the keys of the combined model are flat tuples, the condition values of every attacker
+    with condition fields, in the order of attackers, and condition_fields is the list of
+    the condition fields of each of them.
+    the same pair of models is only summed once, however many condition keys share it
+
+    :param attackers: a list of Attacker objects
+    :param pruning: a PruningPolicy object that is applied to every summed ProbModel
+    :param name: the name of the combined attacker, the names joined with ' plus ' by default
+    :param cache: the ProbModelSumCache of the pairwise sums, PROB_MODEL_SUM_CACHE by default
+    :return: Attacker
+    """
+    if cache is None:
+        cache = PROB_MODEL_SUM_CACHE
+    attackers = [a for a in attackers if a is not None and a.model is not None]
+    if len(attackers) == 0:
+        raise ValueError("there are no attackers to combine")
+    if name is None:
+        name = ' plus '.join(a.name for a in attackers)
+    condition_fields = []
+    for a in attackers:
+        if len(a.condition_fields) > 0:
+            condition_fields += [leaf for leaf in _condition_field_leaves(a.condition_fields) if len(leaf) > 0]
+
+    levels = [_flat_models(a) for a in attackers]
+    while len(levels) > 1:
+        sums = {}
+        next_levels = []
+        for i in range(0, len(levels) - 1, 2):
+            combined = {}
+            for k1, m1 in levels[i].items():
+                for k2, m2 in levels[i + 1].items():
+                    pair = (id(m1), id(m2))
+                    if pair not in sums:
+                        sums[pair] = cache.add(m1, m2, pruning)
+                    combined[k1 + k2] = sums[pair]
+            next_levels.append(combined)
+        if len(levels) % 2 == 1:
+            next_levels.append(levels[-1])
+        levels = next_levels
+    model = levels[0]
+    if list(model.keys()) == [()]:
+        model = model[()]
+    return Attacker(None, model, name, condition_fields, flat_keys=True)
+
+
+ATTACKER_FORMAT_VERSION = 1
+
+
+def _key_to_json(key):
+    """
+    turn a condition key into a JSON value, the tuples become lists
+    """
+    if isinstance(key, tuple):
+        return [_key_to_json(item) for item in key]
+    if isinstance(key, np.generic):
+        return key.item()
+    return key
+
+
+def _key_from_json(key):
+    if isinstance(key, list):
+        return tuple(_key_from_json(item) for item in key)
+    return key
+
+
+def save_attacker(attacker, path):
+    """
+    save an attacker, single or combined, to the directory path
+
+    the models are stored once each, however many condition keys share them, as flat arrays:
+    masks.npy, the uint64 masks of the combinations of all the models over the list of all their fields,
+    one row per combination, field j is bit j % 64 of word j // 64, so any number of fields can be saved,
+    prob_list.npy, their probabilities, and model_indptr.npy, the start of each model in the two arrays.
+    attacker.json holds the name, the condition fields, the condition keys, the list of all the fields,
+    the fields and the discarded mass of each model.
+    the arrays can be memory-mapped by load_attacker
+
+    :param attacker: an Attacker object
+    :param path: the directory to write, it is created if it does not exist
+    """
+    if attacker.model is None:
+        raise ValueError("the attacker does not have a model")
+    if isinstance(attacker.model, dict):
+        keys = list(attacker.model.keys())
+        models = list(attacker.model.values())
+    else:
+        keys = None
+        models = [attacker.model]
+
+    all_fields = []
+    field_index = {}
+    model_index = {}
+    unique_models = []
+    key_model = []
+    for model in models:
+        if id(model) not in model_index:
+            model_index[id(model)] = len(unique_models)
+            unique_models.append(model)
+        key_model.append(model_index[id(model)])
+
+    fields_arrays = []
+    prob_list = []
+    model_fields = []
+    discarded_mass = []
+    for model in unique_models:
+        # the fields_array of a BitmaskProbModel is read from its masks
+        model = _as_prob_model(model)
+        for field in model.fields:
+            if field not in field_index:
+                field_index[field] = len(all_fields)
+                all_fields.append(field)
+        fields_arrays.append(np.asarray(model.fields_array).reshape(len(model.prob_list), len(model.fields)))
+        prob_list.append(np.asarray(model.prob_list, dtype=np.float64))
+        model_fields.append([field_index[field] for field in model.fields])
+        discarded_mass.append(float(getattr(model, 'discarded_mass', 0.0)))
+    model_indptr = np.zeros(len(unique_models) + 1, dtype=np.int64)
+    model_indptr[1:] = np.cumsum([len(p) for p in prob_list])
+
+    masks = np.zeros((model_indptr[-1], max(1, (len(all_fields) + 63) // 64)), dtype=np.uint64)
+    for i, fields_array in enumerate(fields_arrays):
+        rows = masks[model_indptr[i]:model_indptr[i + 1]]
+        for j, b in enumerate(model_fields[i]):
+            rows[:, b // 64] |= fields_array[:, j].astype(np.uint64) << np.uint64(b % 64)
+
+    meta = {
+        'version': ATTACKER_FORMAT_VERSION,
+        'name': attacker.name,
+        'condition_fields': attacker.condition_fields,
+        'flat_keys': attacker.flat_keys,
+        'keys': None if keys is None else [_key_to_json(k) for k in keys],
+        'key_model': key_model,
+        'fields': all_fields,
+        'model_fields': model_fields,
+        'discarded_mass': discarded_mass,
+    }
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'masks.npy'), masks)
+    np.save(os.path.join(path, 'prob_list.npy'), np.concatenate(prob_list))
+    np.save(os.path.join(path, 'model_indptr.npy'), model_indptr)
+    with open(os.path.join(path, 'attacker.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_attacker(path, mmap_mode='r', bitmask=False):
+    """
+    load an attacker saved by save_attacker
+
+    :param path: the directory written by save_attacker
+    :param mmap_mode: the mmap_mode of np.load, 'r' maps the arrays read-only so that
+    the processes that load the same attacker share the pages, None reads them into memory
+    :param bitmask: if True, the models are BitmaskProbModel objects over one new FieldRegistry
+    whose masks and probabilities are views of the mapped arrays, the attacker can have at most 64 fields,
+    otherwise they are ProbModel objects with the fields in the order they were saved
+    :return: Attacker
+    """
+    with open(os.path.join(path, 'attacker.json')) as f:
+        meta = json.load(f)
+    if meta.get('version') != ATTACKER_FORMAT_VERSION:
+        raise ValueError("unsupported attacker format version: " + str(meta.get('version')))
+    masks = np.load(os.path.join(path, 'masks.npy'), mmap_mode=mmap_mode)
+    prob_list = np.load(os.path.join(path, 'prob_list.npy'), mmap_mode=mmap_mode)
+    model_indptr = np.load(os.path.join(path, 'model_indptr.npy'))
+    all_fields = meta['fields']
+    if bitmask:
+        if len(all_fields) > 64:
+            raise ValueError("the attacker has more than 64 fields, it can only be loaded with bitmask=False")
+        registry = FieldRegistry(all_fields)
+
+    models = []
+    for i, bits in enumerate(meta['model_fields']):
+        start, end = model_indptr[i], model_indptr[i + 1]
+        if bitmask:
+            models.append(BitmaskProbModel(masks[start:end, 0], prob_list[start:end], registry,
+                                           meta['discarded_mass'][i]))
+        else:
+            fields = [all_fields[b] for b in bits]
+            fields_array = np.zeros((end - start, len(fields)), dtype=np.uint8)
+            for j, b in enumerate(bits):
+                fields_array[:, j] = (masks[start:end, b // 64] >> np.uint64(b % 64)) & np.uint64(1)
+            models.append(ProbModel(fields, fields_array, prob_list[start:end], meta['discarded_mass'][i]))
+
+    if meta['keys'] is None:
+        model = models[0]
+    else:
+        model = {_key_from_json(k): models[m] for k, m in zip(meta['keys'], meta['key_model'])}
+    return Attacker(None, model, meta['name'], meta['condition_fields'], flat_keys=meta['flat_keys'])
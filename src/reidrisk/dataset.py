@@ -6,7 +6,15 @@ last modified: 12/8/2022
 import pandas as pd
 import numpy as np
 from google.cloud import bigquery
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+from .encoding import EncodedTable
+
+# the version of the layout of the cached pipeline output, change it to invalidate the old caches
+PIPELINE_CACHE_VERSION = 1
 
 
 def combine(col_to_combine):
@@ -20,6 +28,25 @@ def combine(col_to_combine):
     return v_str
 
 
+def combine_columns(df, col_to_combine):
+    """
+    the column-wise version of combine, join the values of the columns in col_to_combine of every row with ' and ',
+    the null and empty values are skipped, a row without any value is ''
+    :return: np.ndarray of object, one value per row of df
+    """
+    v_str = np.full(df.shape[0], '', dtype=object)
+    has_value = np.zeros(df.shape[0], dtype=bool)
+    for col in col_to_combine:
+        values = df[col].values.astype(object)
+        valid = pd.notnull(values) & (values != '')
+        join = valid & has_value
+        v_str[join] = v_str[join] + ' and ' + values[join]
+        first = valid & ~has_value
+        v_str[first] = values[first]
+        has_value |= valid
+    return v_str
+
+
 def generalize_birth_year(x, birthyear_group_size):
     if len(str(x)) < 4:
         return ''
@@ -27,6 +54,37 @@ def generalize_birth_year(x, birthyear_group_size):
         return str(int(str(x)[:4]) - (int(str(x)[:4]) % (birthyear_group_size)))
 
 
+def generalize_years(values, year_bin=1, bin_edges=None):
+    """
+    the column-wise version of generalize_birth_year, the year is the first four characters of a value,
+    a year or a date such as '1990-05-01', every distinct value is parsed once and binned with integer arithmetic
+    :param values: the values of a column
+    :param year_bin: the size of the bins, a year is generalized to year - year % year_bin
+    :param bin_edges: the sorted edges of bins of any sizes, a year in [bin_edges[i], bin_edges[i + 1])
+    is generalized to bin_edges[i], it is used instead of year_bin if it is not None
+    :return: np.ndarray of object, the generalized years as strings,
+    '' for the null values, the values shorter than four characters, the values that do not start with a year
+    and the years outside bin_edges
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    text = pd.Series(uniques, dtype=object).astype(str)
+    prefix = text.str[:4]
+    valid = ((text.str.len() >= 4) & prefix.str.fullmatch(r'\s*[+-]?\d+\s*')).values.astype(bool)
+    years = np.zeros(len(text), dtype=np.int64)
+    years[valid] = prefix[valid].astype(np.int64).values
+    if bin_edges is None:
+        years = years - years % year_bin
+    else:
+        bin_edges = np.asarray(bin_edges, dtype=np.int64)
+        index = np.searchsorted(bin_edges, years, side='right') - 1
+        valid &= (index >= 0) & (index < len(bin_edges) - 1)
+        years = bin_edges[np.clip(index, 0, len(bin_edges) - 1)]
+    # the last label is for the null values, their code is -1
+    labels = np.full(len(text) + 1, '', dtype=object)
+    labels[:-1][valid] = years[valid].astype(str).astype(object)
+    return labels[codes]
+
+
 class Dataset:
     def __init__(
             self,
@@ -45,8 +103,28 @@ class Dataset:
             bigquery_table=None,
             # missing_set is the set of values that are considered missing, for example, ['NA', 'N/A', 'Skip','prefer not to answer']
             missing_set=None,
-            year_bin=1
+            year_bin=1,
+            # the edges of the year bins, such as [1900, 1950, 1980, 2000, 2030], year_bin is used if it is None
+            year_bin_edges=None,
+            # the lists of the categories of the columns, such as the categories of a previous extract,
+            # convert_cate_to_numeric gives these values the same codes
+            vocabularies=None,
+            # the directory of the cached pipeline outputs, a dataset loaded from a file whose pipeline output
+            # is cached with the same parameters is loaded from the cache without reading the file,
+            # then dset is the output of pipeline() from the start, while without a cache it is the file
+            # until pipeline() runs, so call pipeline() before using dset to get the same data in both cases
+            cache_dir=None,
+            # the columns to read from the file, such as reidrisk.risk.get_dataset_fields of the Risk field maps,
+            # the source columns of the multi-select fields and death_date for year_of_death are added
+            usecols=None,
+            # the dtypes of the columns, passed to pd.read_csv, 'infer' reads the text columns of the first
+            # infer_rows rows and loads them as category
+            dtype=None,
+            infer_rows=1000,
+            # the parser engine of pd.read_csv, such as 'c' or 'pyarrow'
+            engine=None
     ):
+        self._from_cache = False
         self.dset = dset
         self.source = source
         self.dfile = dfile
@@ -60,14 +138,126 @@ class Dataset:
         self.bigquery_service_account_key_file = bigquery_service_account_key_file
         self.bigquery_dataset = bigquery_dataset
         self.bigquery_table = bigquery_table
-        self.load()
-        self.columns = self.dset.columns
-        self.selected_columns = self.columns
+        self.usecols = usecols
+        self.dtype = dtype
+        self.infer_rows = infer_rows
+        self.engine = engine
         self.missing_set = missing_set
         self.year_bin = year_bin
+        self.year_bin_edges = year_bin_edges
+        self.vocabularies = vocabularies
         self.dset_numeric = None
         self.null_df = None
         self.categories_dict = {}
+        self.encoded_table = None
+        self.cache_dir = cache_dir
+        self.cache_path = self.get_cache_path()
+        if self.cache_path is not None and os.path.isdir(self.cache_path):
+            self.load_from_cache()
+        else:
+            self.load()
+            self.columns = self.dset.columns
+        self.selected_columns = self.columns
+
+    @property
+    def dset(self):
+        """
+        the dataset, when the pipeline output is loaded from the cache,
+        it is the output of pipeline() decoded from the cached codes the first time it is used, the null values are ''
+        """
+        if self._dset is None and self._from_cache:
+            self._dset = self.encoded_table.decode(null_value='')
+        return self._dset
+
+    @dset.setter
+    def dset(self, value):
+        self._dset = value
+
+    @property
+    def dset_numeric(self):
+        """
+        the codes of the dataset, when the pipeline output is loaded from the cache,
+        the columns are read-only views of the memory-mapped codes
+        """
+        if self._dset_numeric is None and self._from_cache:
+            self._dset_numeric = self.encoded_table.to_numeric_df(copy=False)
+        return self._dset_numeric
+
+    @dset_numeric.setter
+    def dset_numeric(self, value):
+        self._dset_numeric = value
+
+    @property
+    def null_df(self):
+        """
+        the null flags of the dataset, when the pipeline output is loaded from the cache,
+        they are unpacked from the cached null mask the first time they are used
+        """
+        if self._null_df is None and self._from_cache:
+            self._null_df = self.encoded_table.null_df()
+        return self._null_df
+
+    @null_df.setter
+    def null_df(self, value):
+        self._null_df = value
+
+    def get_cache_path(self):
+        """
+        the directory of the cached pipeline output, its name is the hash of the fingerprint of the source file,
+        its path, size and modification time, and of the parameters of the pipeline
+        return None if there is no cache_dir or the dataset is not loaded from a file
+        """
+        if self.cache_dir is None or self.source != 'file' or self.dfile is None:
+            return None
+        stat = os.stat(self.dfile)
+        key = {
+            'version': PIPELINE_CACHE_VERSION,
+            'dfile': os.path.abspath(self.dfile),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'colnames': self.colnames,
+            'header': self.header,
+            'index_col': self.index_col,
+            'sep': self.sep,
+            'null_value_list': self.null_value_list,
+            'data_model': self.data_model,
+            'multi_select_field_values': self.multi_select_field_values,
+            'year_bin': self.year_bin,
+            'year_bin_edges': self.year_bin_edges,
+            'vocabularies': self.vocabularies,
+            'usecols': self.usecols,
+            'dtype': self.dtype,
+            'infer_rows': self.infer_rows,
+        }
+        digest = hashlib.blake2b(json.dumps(key, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def load_from_cache(self):
+        """
+        load the pipeline output from self.cache_path, the codes are memory-mapped,
+        dset, dset_numeric and null_df are built from them when they are first used
+        """
+        self.encoded_table = EncodedTable.load(self.cache_path)
+        self._from_cache = True
+        self.dset = None
+        self.dset_numeric = None
+        self.null_df = None
+        self.columns = pd.Index(self.encoded_table.columns)
+        self.categories_dict = self.encoded_table.categories
+
+    def save_to_cache(self):
+        """
+        save the pipeline output to self.cache_path, it is written to a temporary directory that is then renamed,
+        so a reader never sees a partly written cache
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir)
+        self.get_encoded_table().save(tmp_path)
+        try:
+            os.rename(tmp_path, self.cache_path)
+        except OSError:
+            # another process has written the same cache
+            shutil.rmtree(tmp_path, ignore_errors=True)
 
     def load(self):
         if self.source == "dataframe":
@@ -76,7 +266,11 @@ class Dataset:
             if self.dfile is None:
                 raise ValueError("dataset file is not specified")
             else:
-                self.dset = pd.read_csv(self.dfile, sep=self.sep, header=self.header, index_col=self.index_col)
+                usecols = self.get_usecols()
+                dtype = self.infer_dtype(usecols) if self.dtype == 'infer' else self.dtype
+                kwargs = {} if self.engine is None else {'engine': self.engine}
+                self.dset = pd.read_csv(self.dfile, sep=self.sep, header=self.header, index_col=self.index_col,
+                                        usecols=usecols, dtype=dtype, **kwargs)
 
         elif self.source == "bigquery":
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.bigquery_service_account_key_file
@@ -92,6 +286,34 @@ class Dataset:
         else:
             raise ValueError("dataset source is not specified")
 
+    def get_usecols(self):
+        """
+        the columns of the file to read, in the order of the file, None to read all the columns
+        the columns in self.usecols that are made by the pipeline are replaced by their source columns
+        """
+        if self.usecols is None:
+            return None
+        file_columns = list(pd.read_csv(self.dfile, sep=self.sep, header=self.header, index_col=self.index_col,
+                                        nrows=0).columns)
+        multi_select_fields = self.multi_select_field_values if self.multi_select_field_values is not None else {}
+        wanted = set(self.usecols)
+        for field in self.usecols:
+            if field in multi_select_fields:
+                wanted.update(str(field) + '_' + str(name_value) for name_value in multi_select_fields[field])
+            elif field == 'year_of_death':
+                wanted.add('death_date')
+            elif field not in file_columns:
+                raise ValueError("column " + str(field) + " is not in the dataset file")
+        return [col for col in file_columns if col in wanted]
+
+    def infer_dtype(self, usecols=None):
+        """
+        read the first self.infer_rows rows, the text columns are loaded as category
+        """
+        sample = pd.read_csv(self.dfile, sep=self.sep, header=self.header, index_col=self.index_col,
+                             usecols=usecols, nrows=self.infer_rows)
+        return {col: 'category' for col in sample.columns if sample[col].dtype == object}
+
     def combine_multi_select_answers(self):
         """
         this function does these:
@@ -100,20 +322,22 @@ class Dataset:
         """
 
         for field, value_list in self.multi_select_field_values.items():
+            if self.usecols is not None and field not in self.usecols:
+                # the source columns of the field were not loaded
+                continue
             col_to_combine = []
             for name_value in value_list:
                 if name_value not in self.null_value_list:
                     curr_col_name = str(field) + '_' + str(name_value)
                     col_to_combine.append(curr_col_name)
 
-            self.dset[field] = self.dset.apply(lambda x: combine([x[col_name] for col_name in col_to_combine]), axis=1)
+            self.dset[field] = combine_columns(self.dset, col_to_combine)
 
         col_to_remove = []
         for field, value_list in self.multi_select_field_values.items():
             for name_value in value_list:
                 col_to_remove.append(str(field) + '_' + str(name_value))
-        all_cols = self.dset.columns
-        self.dset = self.dset[[i for i in all_cols if i not in col_to_remove]]
+        self.dset.drop(columns=col_to_remove, inplace=True, errors='ignore')
         self.columns = self.dset.columns
 
     def replace_all_unknown_to_empty_string(self):
@@ -121,42 +345,46 @@ class Dataset:
 
     def create_year_of_death_column(self):
         if 'death_date' in self.columns:
-            self.dset['year_of_death'] = self.dset['death_date'].apply(lambda x: str(x)[:4])
+            self.dset['year_of_death'] = self.dset['death_date'].astype(str).str[:4]
+            self.columns = self.dset.columns
 
     def generalize_year(self):
         """
         this function is for the AoU OMOP data, corresponding to the function in the original code base file: generate_dataset.py
         generate_dataset_numeric_df_for_new_aou(self, file_prefix, null_value_list_file, year_bin, filters_for_all_fields_in_analysis, convert_to_numeric=True):
         """
-        if 'YEAR_OF_BIRTH' in self.columns:
-            self.dset['YEAR_OF_BIRTH'] = self.dset['YEAR_OF_BIRTH']. \
-                apply(lambda x: generalize_birth_year(x, self.year_bin))
-
-        if 'birth_year' in self.columns:
-            self.dset['birth_year'] = self.dset['birth_year']. \
-                apply(lambda x: generalize_birth_year(x, self.year_bin))
-
-        if 'year_of_birth' in self.columns:
-            self.dset['year_of_birth'] = self.dset['year_of_birth']. \
-                apply(lambda x: generalize_birth_year(x, self.year_bin))
-
-        if 'year_of_death' in self.columns:
-            self.dset['year_of_death'] = self.dset['year_of_death']. \
-                apply(lambda x: generalize_birth_year(x, self.year_bin))
+        for col in ['YEAR_OF_BIRTH', 'birth_year', 'year_of_birth', 'year_of_death']:
+            if col in self.columns:
+                self.dset[col] = generalize_years(self.dset[col].values, self.year_bin, self.year_bin_edges)
 
     def convert_cate_to_numeric(self):
         """
         this function corresponds to the function in the original code base file: targeted_attack_risk_from_local_file_for_new_aou.py
         convert_cate_to_numeric
+        every column is encoded with one pass, '' is null, the categories in self.vocabularies keep their codes
+        """
+        self.encoded_table = EncodedTable.from_dataframe(self.dset, [''], self.vocabularies, self.columns)
+        self.categories_dict = self.encoded_table.categories
+        self.dset_numeric = self.encoded_table.to_numeric_df()
+        self.dset_numeric.index = self.dset.index
+        self.null_df = self.encoded_table.null_df()
+        self.null_df.index = self.dset.index
+
+    def get_encoded_table(self):
+        """
+        the compact integer-coded table of the dataset,
+        built from dset_numeric after pipeline() has run, otherwise encoded from dset without modifying it
         """
-        self.dset_numeric = self.dset.replace('', np.nan)
-        self.null_df = self.dset_numeric.isnull()
-        for field_i in self.columns:
-            self.categories_dict[field_i] = dict(
-                enumerate(self.dset_numeric[field_i].astype('category').cat.categories))
-            self.dset_numeric[field_i] = self.dset_numeric[field_i].astype('category').cat.codes
+        if self.encoded_table is None:
+            if self.dset_numeric is not None:
+                self.encoded_table = EncodedTable.from_codes(self.dset_numeric, self.categories_dict)
+            else:
+                self.encoded_table = EncodedTable.from_dataframe(self.dset, self.null_value_list)
+        return self.encoded_table
 
     def pipeline(self):
+        if self._from_cache:
+            return self.dset_numeric, self.null_df, self.categories_dict
         if self.data_model is None:
             self.replace_all_unknown_to_empty_string()
             self.convert_cate_to_numeric()
@@ -167,5 +395,7 @@ class Dataset:
             self.create_year_of_death_column()
             self.generalize_year()
             self.convert_cate_to_numeric()
+        if self.cache_path is not None:
+            self.save_to_cache()
         return self.dset_numeric, self.null_df, self.categories_dict
 
@@ -0,0 +1,211 @@
+"""
+author: Weiyi Xia
+
+This module contains the compact integer-coded representation of a dataset
+that is shared by Dataset, the group size computation and Risk.
+
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+def smallest_int_dtype(max_value, min_value=-1):
+    """
+    :return: the smallest signed integer dtype that holds all the values between min_value and max_value
+    """
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        if np.iinfo(dtype).min <= min_value and max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("the values do not fit in int64")
+
+
+def encode_column(values, null_values=None, vocabulary=None):
+    """
+    encode a column with one pd.factorize call, the null values are found and
+    the categories are ordered on the distinct values only
+
+    :param values: the values of the column
+    :param null_values: the values that are null, NaN and whitespace-only strings are always null
+    :param vocabulary: the list of the categories declared in advance, their codes are their positions,
+    the values that are not in it are added at the end in sorted order,
+    the categories are the sorted distinct values if it is None
+    :return: (codes, categories), codes is np.ndarray in the smallest int dtype, -1 means null,
+    categories is the list of the values of the codes
+    """
+    try:
+        codes, uniques = pd.factorize(values, sort=True)
+    except TypeError:
+        # the values can not be compared, keep the order they appear in
+        codes, uniques = pd.factorize(values, sort=False)
+    uniques = np.asarray(uniques, dtype=object)
+    is_null = np.array([isinstance(u, str) and u.strip() == '' for u in uniques], dtype=bool).reshape(len(uniques))
+    if null_values is not None and len(null_values) > 0:
+        is_null |= pd.Series(uniques, dtype=object).isin(list(null_values)).values
+    known = uniques[~is_null]
+    if vocabulary is None:
+        categories = list(known)
+        known_codes = np.arange(len(known), dtype=np.int64)
+    else:
+        categories = list(vocabulary)
+        known_codes = pd.Index(categories).get_indexer(known).astype(np.int64)
+        new = known_codes < 0
+        known_codes[new] = np.arange(len(categories), len(categories) + new.sum())
+        categories += list(known[new])
+    # the last entry is for the NaN values, their code is -1
+    remap = np.full(len(uniques) + 1, -1, dtype=np.int64)
+    remap[:-1][~is_null] = known_codes
+    codes = remap[codes].astype(smallest_int_dtype(max(len(categories) - 1, 0)))
+    return codes, categories
+
+
+class EncodedTable:
+    def __init__(self, columns, codes, categories, null_mask=None):
+        """
+        :param columns: the list of column names
+        :param codes: a dictionary, the keys are the column names, the values are np.ndarray of category codes,
+        -1 means null
+        :param categories: a dictionary, the keys are the column names, the values are dictionaries
+        from the codes to the values, the same as Dataset.categories_dict
+        :param null_mask: np.ndarray of uint8, the bit-packed null flags, one row per column,
+        it is computed from the codes if it is None
+        """
+        self.columns = list(columns)
+        self.n_rows = len(codes[self.columns[0]]) if len(self.columns) > 0 else 0
+        self.codes = {}
+        for col in self.columns:
+            col_codes = np.asarray(codes[col])
+            if len(col_codes) != self.n_rows:
+                raise ValueError("the columns do not have the same number of rows")
+            dtype = smallest_int_dtype(max(len(categories[col]) - 1, 0))
+            self.codes[col] = col_codes.astype(dtype, copy=False)
+        self.categories = categories
+        if null_mask is None:
+            null_mask = np.packbits(np.array([self.codes[col] < 0 for col in self.columns]).reshape(
+                len(self.columns), self.n_rows), axis=1)
+        self.null_mask = null_mask
+
+    @classmethod
+    def from_codes(cls, numeric_df, categories):
+        """
+        :param numeric_df: pd.DataFrame of category codes, such as Dataset.dset_numeric
+        :param categories: the decode dictionaries, such as Dataset.categories_dict
+        """
+        return cls(numeric_df.columns, {col: numeric_df[col].values for col in numeric_df.columns}, categories)
+
+    @classmethod
+    def from_dataframe(cls, df, null_values=None, vocabularies=None, columns=None):
+        """
+        encode the columns of df as category codes with one pass over every column, df is not modified,
+        the values in null_values, NaN and whitespace-only strings are null
+
+        :param vocabularies: a dictionary from column names to the lists of their categories declared in advance,
+        such as the categories of a previous extract, so that the same values keep the same codes,
+        the columns that are not in it have sorted categories
+        :param columns: the columns to encode, all the columns by default
+        """
+        columns = list(df.columns) if columns is None else list(columns)
+        vocabularies = {} if vocabularies is None else vocabularies
+        codes = {}
+        categories = {}
+        for col in columns:
+            codes[col], col_categories = encode_column(df[col].values, null_values, vocabularies.get(col, None))
+            categories[col] = dict(enumerate(col_categories))
+        return cls(columns, codes, categories)
+
+    def vocabularies(self):
+        """
+        :return: a dictionary from the column names to the lists of their categories,
+        that can be passed to from_dataframe to encode another extract with the same codes
+        """
+        return {col: [self.categories[col][i] for i in range(len(self.categories[col]))] for col in self.columns}
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.codes.values()) + self.null_mask.nbytes
+
+    def is_null(self, col):
+        """
+        :return: np.ndarray of bool, the null flags of the column unpacked from the null mask
+        """
+        i = self.columns.index(col)
+        return np.unpackbits(self.null_mask[i], count=self.n_rows).astype(bool)
+
+    def cardinalities(self, columns=None):
+        columns = self.columns if columns is None else columns
+        return np.array([len(self.categories[col]) for col in columns], dtype=np.int64)
+
+    def codes_matrix(self, columns=None):
+        """
+        :return: np.ndarray of the codes of the columns, one row per record, in the smallest common int dtype
+        """
+        columns = self.columns if columns is None else list(columns)
+        dtype = np.result_type(*[self.codes[col].dtype for col in columns]) if len(columns) > 0 else np.int8
+        matrix = np.empty((self.n_rows, len(columns)), dtype=dtype)
+        for j, col in enumerate(columns):
+            matrix[:, j] = self.codes[col]
+        return matrix
+
+    def to_numeric_df(self, copy=True):
+        """
+        :param copy: if False, the columns of the dataframe share the memory of the codes,
+        such as the memory-mapped codes of a loaded table
+        :return: pd.DataFrame of the codes, the same as Dataset.dset_numeric
+        """
+        return pd.DataFrame({col: self.codes[col] for col in self.columns}, copy=copy)
+
+    def null_df(self):
+        """
+        :return: pd.DataFrame of bool, the same as Dataset.null_df
+        """
+        return pd.DataFrame({col: self.is_null(col) for col in self.columns})
+
+    def decode(self, null_value=np.nan):
+        """
+        :param null_value: the value of the null codes
+        :return: pd.DataFrame of the original values
+        """
+        df = {}
+        for col in self.columns:
+            values = pd.Index(list(self.categories[col].values()), dtype=object)
+            df[col] = pd.Series(pd.Categorical.from_codes(self.codes[col], categories=values)).astype(object)
+            if not pd.isnull(null_value):
+                df[col] = df[col].where(self.codes[col] >= 0, null_value)
+        return pd.DataFrame(df)
+
+    def save(self, path):
+        """
+        save the table to the directory path, the codes of column i are in codes_i.npy,
+        the packed null flags in null_mask.npy, the columns and the categories in table.json
+        """
+        os.makedirs(path, exist_ok=True)
+        for i, col in enumerate(self.columns):
+            np.save(os.path.join(path, 'codes_' + str(i) + '.npy'), self.codes[col])
+        np.save(os.path.join(path, 'null_mask.npy'), self.null_mask)
+        meta = {'columns': [_to_json(col) for col in self.columns],
+                'categories': [[_to_json(self.categories[col][i]) for i in range(len(self.categories[col]))]
+                               for col in self.columns]}
+        with open(os.path.join(path, 'table.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        load a table saved by EncodedTable.save
+        :param mmap_mode: the mmap_mode of np.load, 'r' maps the codes read-only instead of reading them
+        """
+        with open(os.path.join(path, 'table.json')) as f:
+            meta = json.load(f)
+        columns = meta['columns']
+        codes = {col: np.load(os.path.join(path, 'codes_' + str(i) + '.npy'), mmap_mode=mmap_mode)
+                 for i, col in enumerate(columns)}
+        categories = {col: dict(enumerate(meta['categories'][i])) for i, col in enumerate(columns)}
+        null_mask = np.load(os.path.join(path, 'null_mask.npy'), mmap_mode=mmap_mode)
+        return cls(columns, codes, categories, null_mask)
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
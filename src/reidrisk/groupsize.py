@@ -1,6 +1,505 @@
+import os
+import weakref
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
 
+_MAX_PACKED_KEY = np.iinfo(np.int64).max
+
+
+def encode_columns(df):
+    '''
+    encode every column of df as integer codes, the missing values are encoded as -1
+
+    :param df: pd.DataFrame
+    :return: (codes, cardinalities), codes is a np.ndarray of shape df.shape,
+    cardinalities is the number of distinct non-missing values in each column
+    '''
+    codes = np.empty(df.shape, dtype=np.int64)
+    cardinalities = np.zeros(df.shape[1], dtype=np.int64)
+    for j in range(df.shape[1]):
+        column = df.iloc[:, j]
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            # an object Series of numbers makes factorize warn about the dtype of its uniques
+            column = column.to_numpy()
+        col_codes, uniques = pd.factorize(column)
+        codes[:, j] = col_codes
+        cardinalities[j] = len(uniques)
+    return codes, cardinalities
+
+
+def replace_missing_with_nan(df, missing_values, copy=True):
+    '''
+    replace the missing values in df with np.nan, one column at a time
+
+    :param df: pd.DataFrame
+    :param missing_values: the values that are considered missing, whitespace-only strings are always missing
+    :param copy: if False, df is modified in place
+    :return: pd.DataFrame
+    '''
+    if copy:
+        df = df.copy()
+    missing_values = list(missing_values) if missing_values is not None else []
+    for col in df.columns:
+        values = df[col]
+        is_missing = values.isin(missing_values) if len(missing_values) > 0 else pd.Series(False, index=df.index)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            distinct = values.cat.categories
+        elif values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            distinct = pd.unique(values)
+        else:
+            distinct = []
+        # only the string values can be blank, the test is done on the distinct values
+        blank = [v for v in distinct if isinstance(v, str) and v.strip() == '']
+        if len(blank) > 0:
+            is_missing |= values.isin(blank)
+        if is_missing.any():
+            df[col] = values.mask(is_missing)
+    return df
+
+
+def _column_blocks(cardinalities):
+    '''
+    split the columns into consecutive blocks whose mixed radix keys fit in int64
+
+    :return: a list of (first column, end column, the place value of each column in the block, the block radix)
+    '''
+    return _column_blocks_of(tuple(np.asarray(cardinalities, dtype=np.int64).tolist()))
+
+
+@lru_cache(maxsize=4096)
+def _column_blocks_of(cardinalities):
+    # the lattice engine packs the same few column sets many times, so the blocks are computed once per set
+    blocks = []
+    start = 0
+    radix_total = 1
+    cards = [max(c, 1) for c in cardinalities]
+    for j, card in enumerate(cards + [None]):
+        if card is None or radix_total * card > _MAX_PACKED_KEY:
+            if j > start:
+                # the last column of the block is the least significant
+                place = np.cumprod([1] + cards[j - 1:start:-1], dtype=np.int64)[::-1]
+                blocks.append((start, j, place, radix_total))
+            start = j
+            radix_total = 1
+        if card is not None:
+            radix_total *= card
+    return blocks
+
+
+def _pack_keys(codes, cardinalities):
+    '''
+    pack each row of codes into one int64 key using mixed radix arithmetic
+    rows with the same codes get the same key
+    return None if the keys do not fit in int64
+    '''
+    blocks = _column_blocks(cardinalities)
+    if len(blocks) == 0:
+        return np.zeros(codes.shape[0], dtype=np.int64)
+    if len(blocks) > 1:
+        return None
+    return codes.astype(np.int64, copy=False) @ blocks[0][2]
+
+
+def _pack_keys_jointly(codes_list, cardinalities):
+    '''
+    pack the rows of several code arrays into keys that are comparable between the arrays
+    every block of columns that fits in int64 is packed at once, and the partial keys
+    are compacted with np.unique whenever they would overflow int64
+    '''
+    codes = np.concatenate(codes_list).astype(np.int64, copy=False)
+    keys = np.zeros(codes.shape[0], dtype=np.int64)
+    radix_total = 1
+    for start, end, place, block_radix in _column_blocks(cardinalities):
+        block_keys = codes[:, start:end] @ place
+        if radix_total * block_radix > _MAX_PACKED_KEY:
+            uniques, keys = np.unique(keys, return_inverse=True)
+            keys = keys.astype(np.int64)
+            radix_total = max(len(uniques), 1)
+        if radix_total * block_radix > _MAX_PACKED_KEY:
+            uniques, block_keys = np.unique(block_keys, return_inverse=True)
+            block_keys = block_keys.astype(np.int64)
+            block_radix = max(len(uniques), 1)
+        keys = keys * block_radix + block_keys
+        radix_total *= block_radix
+    split_at = np.cumsum([len(c) for c in codes_list])[:-1]
+    return np.split(keys, split_at)
+
+
+def _count_keys(keys, weights):
+    '''
+    :return: (sorted unique keys, the total weight of each key, the index of each key in the unique keys)
+    '''
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights, minlength=len(unique_keys))
+    return unique_keys, np.rint(counts).astype(np.int64), inverse
+
+
+def _lookup_counts(query_keys, table_keys, table_counts):
+    '''
+    look up query_keys in the sorted table_keys, the keys that are not in the table get 0
+    '''
+    if len(table_keys) == 0:
+        return np.zeros(len(query_keys), dtype=np.int64)
+    pos = np.searchsorted(table_keys, query_keys)
+    pos[pos == len(table_keys)] = 0
+    found = table_keys[pos] == query_keys
+    return np.where(found, table_counts[pos], 0)
+
+
+def _get_pattern_table(codes, cardinalities, weights, row_indexes, known):
+    '''
+    count the known values of the rows of one missing pattern
+
+    :return: (sorted keys, counts, the group size of each row within the pattern, whether the keys are canonical)
+    the keys are canonical if they can be compared with the keys packed for other patterns
+    '''
+    c_codes = codes[np.ix_(row_indexes, known)]
+    keys = _pack_keys(c_codes, cardinalities[known])
+    canonical = keys is not None
+    if not canonical:
+        keys = _pack_keys_jointly([c_codes], cardinalities[known])[0]
+    unique_keys, counts, inverse = _count_keys(keys, weights[row_indexes])
+    return unique_keys, counts, counts[inverse], canonical
+
+
+def _get_offspring_group_size(codes, cardinalities, weights, row_indexes, offsprings, get_rows, get_table):
+    '''
+    add up the rows of the offspring patterns that agree with each row of a pattern
+
+    :param offsprings: a list of (offspring pattern index, known columns of the offspring)
+    :param get_rows: function that returns the row indexes of an offspring pattern
+    :param get_table: function that returns the (keys, counts, canonical) of an offspring pattern
+    :return: np.ndarray of int, one value per row in row_indexes
+    '''
+    c_size = np.zeros(len(row_indexes), dtype=np.int64)
+    for offspring, o_known in offsprings:
+        o_rows = get_rows(offspring)
+        if len(o_known) == 0:
+            c_size += weights[o_rows].sum()
+            continue
+        query_codes = codes[np.ix_(row_indexes, o_known)]
+        query_keys = _pack_keys(query_codes, cardinalities[o_known])
+        table_keys, table_counts, canonical = get_table(offspring)
+        if query_keys is None or not canonical:
+            query_keys, o_keys = _pack_keys_jointly(
+                [query_codes, codes[np.ix_(o_rows, o_known)]], cardinalities[o_known])
+            table_keys, table_counts, _ = _count_keys(o_keys, weights[o_rows])
+        c_size += _lookup_counts(query_keys, table_keys, table_counts)
+    return c_size
+
+
+def get_equivalent_group_size_from_codes(codes, cardinalities, missing_patterns, weights=None, n_jobs=1):
+    '''
+    vectorized equivalent group size, a missing value matches any value
+
+    the group size of a row is the total weight of the rows with the same missing pattern
+    and the same known values, plus the rows of every offspring pattern that agree with it on
+    the known columns of the offspring
+
+    :param codes: np.ndarray of int, one row per record, -1 means missing
+    :param cardinalities: the number of distinct codes of each column
+    :param missing_patterns: MissingPatterns of codes >= 0
+    :param weights: the number of records each row stands for, 1 by default
+    :param n_jobs: the number of worker processes, -1 uses all the cpus, 1 runs in this process
+    :return: np.ndarray of int
+    '''
+    if weights is None:
+        weights = np.ones(codes.shape[0], dtype=np.int64)
+    if n_jobs != 1:
+        return _get_equivalent_group_size_parallel(codes, cardinalities, missing_patterns, weights, n_jobs)
+    u_p = missing_patterns.unique_patterns
+    groups_by_missing = missing_patterns.pattern_groups
+    group_size = np.zeros(codes.shape[0], dtype=np.int64)
+    # count tables of the patterns, keyed on the known columns of each pattern
+    tables = {}
+    for pattern_key, row_indexes in groups_by_missing.items():
+        known = np.flatnonzero(u_p[pattern_key])
+        unique_keys, counts, c_size, canonical = _get_pattern_table(
+            codes, cardinalities, weights, row_indexes, known)
+        tables[pattern_key] = (unique_keys, counts, canonical)
+        group_size[row_indexes] = c_size
+
+    for pattern_key, row_indexes in groups_by_missing.items():
+        offsprings = [(o, np.flatnonzero(u_p[o])) for o in missing_patterns.linked_patterns[pattern_key]]
+        group_size[row_indexes] += _get_offspring_group_size(
+            codes, cardinalities, weights, row_indexes, offsprings, groups_by_missing.get, tables.get)
+    return group_size
+
+
+# the shared memory arrays a worker process has attached to, keyed by the name of the shared memory block
+_worker_arrays = {}
+
+
+def _share_array(array):
+    '''
+    copy array into a new shared memory block
+    :return: (the SharedMemory, the spec that _attach_array needs to read it)
+    '''
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec):
+    name, shape, dtype = spec
+    if name not in _worker_arrays:
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _worker_arrays[name][1]
+
+
+def _pattern_table_task(specs, pattern_key, known):
+    codes, cardinalities, weights, order, indptr = [_attach_array(spec) for spec in specs]
+    row_indexes = order[indptr[pattern_key]:indptr[pattern_key + 1]]
+    return _get_pattern_table(codes, cardinalities, weights, row_indexes, known)
+
+
+def _offspring_group_size_task(specs, table_specs, pattern_key, offsprings):
+    codes, cardinalities, weights, order, indptr = [_attach_array(spec) for spec in specs]
+    table_keys, table_counts, table_indptr, canonical = [_attach_array(spec) for spec in table_specs]
+
+    def get_rows(p):
+        return order[indptr[p]:indptr[p + 1]]
+
+    def get_table(p):
+        return (table_keys[table_indptr[p]:table_indptr[p + 1]],
+                table_counts[table_indptr[p]:table_indptr[p + 1]], bool(canonical[p]))
+
+    return _get_offspring_group_size(codes, cardinalities, weights, get_rows(pattern_key), offsprings,
+                                     get_rows, get_table)
+
+
+def _get_equivalent_group_size_parallel(codes, cardinalities, missing_patterns, weights, n_jobs):
+    '''
+    the same computation as get_equivalent_group_size_from_codes with the patterns spread over worker processes,
+    the codes and the count tables are passed to the workers in shared memory instead of being pickled
+    '''
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count()
+    u_p = missing_patterns.unique_patterns
+    n_patterns = u_p.shape[0]
+    order = np.argsort(missing_patterns.pattern_index, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(missing_patterns.pattern_index, minlength=n_patterns))])
+    blocks = []
+    try:
+        specs = []
+        for array in [codes, np.asarray(cardinalities), np.asarray(weights), order, indptr]:
+            shm, spec = _share_array(array)
+            blocks.append(shm)
+            specs.append(spec)
+        group_size = np.zeros(codes.shape[0], dtype=np.int64)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_pattern_table_task, specs, p, np.flatnonzero(u_p[p]))
+                       for p in range(n_patterns)]
+            tables = [f.result() for f in futures]
+            for p in range(n_patterns):
+                group_size[order[indptr[p]:indptr[p + 1]]] = tables[p][2]
+
+            table_indptr = np.concatenate([[0], np.cumsum([len(t[0]) for t in tables])])
+            table_specs = []
+            for array in [np.concatenate([t[0] for t in tables]), np.concatenate([t[1] for t in tables]),
+                          table_indptr, np.array([t[3] for t in tables])]:
+                shm, spec = _share_array(array)
+                blocks.append(shm)
+                table_specs.append(spec)
+            futures = {}
+            for p in range(n_patterns):
+                offsprings = [(o, np.flatnonzero(u_p[o])) for o in missing_patterns.linked_patterns[p]]
+                if len(offsprings) > 0:
+                    futures[p] = executor.submit(_offspring_group_size_task, specs, table_specs, p, offsprings)
+            for p, f in futures.items():
+                group_size[order[indptr[p]:indptr[p + 1]]] += f.result()
+        return group_size
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+def _unique_rows(codes, cardinalities):
+    '''
+    :return: (the unique rows of codes, the index of each row in the unique rows)
+    '''
+    keys = _pack_keys(codes, cardinalities)
+    if keys is None:
+        keys = _pack_keys_jointly([codes], cardinalities)[0]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return codes[first], inverse
+
+
+def _lookup_rows(query_codes, table_codes, table_values, cardinalities):
+    '''
+    look up the rows of query_codes in the unique rows table_codes, the rows that are not in the table get 0
+    '''
+    if len(table_codes) == 0 or len(query_codes) == 0:
+        return np.zeros(len(query_codes), dtype=np.int64)
+    query_keys = _pack_keys(query_codes, cardinalities)
+    table_keys = _pack_keys(table_codes, cardinalities) if query_keys is not None else None
+    if table_keys is None:
+        query_keys, table_keys = _pack_keys_jointly([query_codes, table_codes], cardinalities)
+    order = np.argsort(table_keys)
+    return _lookup_counts(query_keys, table_keys[order], table_values[order])
+
+
+def _mask_columns(mask, n_cols):
+    return [j for j in range(n_cols) if (mask >> j) & 1]
+
+
+def get_equivalent_group_size_lattice_dp(codes, cardinalities, missing_patterns, weights=None):
+    '''
+    equivalent group size computed with a sum-over-subsets (zeta transform) over the pattern lattice,
+    gives the same result as get_equivalent_group_size_from_codes
+
+    h_0[S] is the count table of pattern S, and after column c is processed
+    h[S] += h[S without c] for every lattice node S that knows c,
+    so h[S] ends up as the sum over all the patterns that are subsets of S.
+    every count table is projected on a dropped column once and shared by all the patterns above it.
+    only the lattice nodes that lie between two patterns are visited, and only at the keys
+    that the rows of the patterns above them ask for.
+    it is faster than the vectorized algorithm when the patterns nest densely, such as when
+    most subsets of a few columns are missing together, since that algorithm visits every pair of nested patterns.
+
+    :param codes: np.ndarray of int, one row per record, -1 means missing
+    :param cardinalities: the number of distinct codes of each column
+    :param missing_patterns: MissingPatterns of codes >= 0
+    :param weights: the number of records each row stands for, 1 by default
+    :return: np.ndarray of int
+    '''
+    n_cols = codes.shape[1]
+    if weights is None:
+        weights = np.ones(codes.shape[0], dtype=np.int64)
+    u_p = missing_patterns.unique_patterns
+    pattern_masks = [sum(1 << int(j) for j in np.flatnonzero(row)) for row in u_p]
+
+    # the unique known values of the rows of each pattern and their counts
+    demand = {}
+    tables = {}
+    inverses = {}
+    for pattern_key, row_indexes in missing_patterns.pattern_groups.items():
+        mask = pattern_masks[pattern_key]
+        cols = _mask_columns(mask, n_cols)
+        unique_codes, inverse = _unique_rows(codes[np.ix_(row_indexes, cols)], cardinalities[cols])
+        counts = np.rint(np.bincount(inverse, weights=weights[row_indexes], minlength=len(unique_codes)))
+        demand[mask] = unique_codes
+        tables[mask] = counts.astype(np.int64)
+        inverses[mask] = inverse
+
+    # h[node] after c columns is nonzero only if a pattern is a subset of node
+    # and agrees with node on the columns c and above, so the patterns are grouped by
+    # their columns c and above at every stage, and a node only checks the patterns of its own group
+    pattern_set = set(pattern_masks)
+    signatures = []
+    for c in range(n_cols):
+        groups = {}
+        for q in pattern_set:
+            groups.setdefault(q >> c, []).append(q & ((1 << c) - 1))
+        signatures.append(groups)
+    nonzero_cache = {}
+
+    def is_nonzero(node, processed):
+        if node in pattern_set:
+            return True
+        key = (node, processed)
+        if key not in nonzero_cache:
+            lows = signatures[processed].get(node >> processed, ())
+            nonzero_cache[key] = any(low & ~node == 0 for low in lows)
+        return nonzero_cache[key]
+
+    # top-down pass, stage_demand[j] holds the keys each node has to be evaluated at after j columns
+    stage_demand = [None] * (n_cols + 1)
+    stage_demand[n_cols] = demand
+    for j in range(n_cols, 0, -1):
+        c = j - 1
+        upper = stage_demand[j]
+        lower = {}
+        for node, keys in upper.items():
+            if is_nonzero(node, c):
+                lower[node] = keys
+        for node, keys in upper.items():
+            if not (node >> c) & 1:
+                continue
+            child = node & ~(1 << c)
+            if not is_nonzero(child, c):
+                continue
+            cols = _mask_columns(node, n_cols)
+            projected = np.delete(keys, cols.index(c), axis=1)
+            if child in lower:
+                child_cols = _mask_columns(child, n_cols)
+                projected, _ = _unique_rows(np.concatenate([lower[child], projected]), cardinalities[child_cols])
+            lower[child] = projected
+        stage_demand[j - 1] = lower
+
+    # bottom-up pass
+    values = {}
+    for node, keys in stage_demand[0].items():
+        if node in tables:
+            cols = _mask_columns(node, n_cols)
+            values[node] = _lookup_rows(keys, demand[node], tables[node], cardinalities[cols])
+        else:
+            values[node] = np.zeros(len(keys), dtype=np.int64)
+    for j in range(1, n_cols + 1):
+        c = j - 1
+        previous_demand = stage_demand[j - 1]
+        previous_values = values
+        values = {}
+        for node, keys in stage_demand[j].items():
+            cols = _mask_columns(node, n_cols)
+            if node in previous_demand and previous_demand[node] is keys:
+                node_values = previous_values[node]
+            elif node in previous_demand:
+                node_values = _lookup_rows(keys, previous_demand[node], previous_values[node], cardinalities[cols])
+            else:
+                node_values = np.zeros(len(keys), dtype=np.int64)
+            child = node & ~(1 << c)
+            if (node >> c) & 1 and child in previous_demand:
+                child_cols = _mask_columns(child, n_cols)
+                projected = np.delete(keys, cols.index(c), axis=1)
+                node_values = node_values + _lookup_rows(
+                    projected, previous_demand[child], previous_values[child], cardinalities[child_cols])
+            values[node] = node_values
+
+    group_size = np.zeros(codes.shape[0], dtype=np.int64)
+    for pattern_key, row_indexes in missing_patterns.pattern_groups.items():
+        mask = pattern_masks[pattern_key]
+        group_size[row_indexes] = values[mask][inverses[mask]]
+    return group_size
+
+
+def pack_patterns(patterns):
+    '''
+    pack each row of a 0/1 pattern array into uint64 bitmask words,
+    column j is bit j % 64 of word j // 64
+
+    :param patterns: np.ndarray of 0 and 1
+    :return: np.ndarray of uint64, one row per pattern
+    '''
+    n_words = max(1, (patterns.shape[1] + 63) // 64)
+    masks = np.zeros((patterns.shape[0], n_words), dtype=np.uint64)
+    for j in range(patterns.shape[1]):
+        masks[:, j // 64] |= patterns[:, j].astype(np.uint64) << np.uint64(j % 64)
+    return masks
+
+
+def get_subset_matrix(masks, block_size=1024):
+    '''
+    :param masks: np.ndarray of uint64 bitmask words, one row per pattern
+    :return: np.ndarray of bool, entry [i, j] is True if pattern j is a proper subset of pattern i
+    '''
+    n = masks.shape[0]
+    subset = np.zeros((n, n), dtype=bool)
+    # the rows are processed in blocks to bound the size of the broadcast temporaries
+    for start in range(0, n, block_size):
+        a = masks[start:start + block_size, None, :]
+        b = masks[None, :, :]
+        subset[start:start + block_size] = np.all((a & b) == b, axis=2)
+    np.fill_diagonal(subset, False)
+    return subset
+
+
 class MissingPatterns:
     def __init__(self, patterns):
         '''
@@ -10,62 +509,48 @@ class MissingPatterns:
         '''
         self.patterns = patterns.astype(int)
         self._check_values_in_patterns() #check if the values in the patterns are 0 or 1
-        self.unique_patterns = np.unique(self.patterns, axis=0)
+        self.unique_patterns, self.pattern_index = np.unique(self.patterns, axis=0, return_inverse=True)
+        self.pattern_index = self.pattern_index.reshape(-1)
+        self.pattern_masks = pack_patterns(self.unique_patterns)
+        #entry [i, j] is True if unique pattern j is an offspring of unique pattern i
+        self._subset_matrix = get_subset_matrix(self.pattern_masks)
         self._tree = self._get_pattern_tree()
+        #the offsprings of all the unique patterns are stored in compressed sparse row form,
+        #the offsprings of pattern i are offspring_indices[offspring_indptr[i]:offspring_indptr[i+1]]
+        self.offspring_indptr = np.concatenate([[0], np.cumsum(self._subset_matrix.sum(axis=1))]).astype(np.intp)
+        self.offspring_indices = np.nonzero(self._subset_matrix)[1].astype(np.intp)
         self.linked_patterns = {}
-        #iterate through the each row in unique_patterns by index
-        #for each row, get the offsprings
-        #use the row index as key, offsprings as value
         for i in range(self.unique_patterns.shape[0]):
-            self.linked_patterns[i] = self._get_offsprings(i)
+            self.linked_patterns[i] = self.offspring_indices[self.offspring_indptr[i]:self.offspring_indptr[i + 1]]
         self.pattern_groups = self._get_pattern_groups()
 
     def _check_values_in_patterns(self):
+        if self.patterns.size == 0:
+            raise ValueError("The patterns can not be empty")
         if np.max(self.patterns) > 1 or np.min(self.patterns) < 0:
             raise ValueError("The values in the patterns should be 0 or 1")
+
     def _get_pattern_tree(self):
+        '''
+        link every pattern to its subsets in the next lower level of known-column counts
+        '''
         u_p = self.unique_patterns
-        levels = {}
-        #every row in u_p is a binary vector
-        #get the counts of 1s in each row in u_p
-        count_list = []
-        for row in u_p:
-            count = np.sum(row)
-            count_list.append(count)
-        #get the unique counts
-        unique_count = np.unique(count_list)
+        count_list = u_p.sum(axis=1)
         #sort the unique counts in descending order
-        unique_count = np.sort(unique_count)[::-1]
-        #for each unique count, get the corresponding rows
-        for count in unique_count:
-            levels[count] = []
-            for i in range(len(u_p)):
-                if count_list[i] == count:
-                    levels[count].append(i)
-        tree = {}
-        #iterate through unique_count by index
+        unique_count = np.sort(np.unique(count_list))[::-1]
         if len(unique_count) < 1:
             #throw a value exception, pattern can not be empty
             raise ValueError("The patterns can not be empty")
-
+        tree = {}
         for i in range(len(unique_count)):
-            #if it is the last level
+            items = np.flatnonzero(count_list == unique_count[i])
             if i == len(unique_count) - 1:
-                for item in levels[unique_count[i]]:
-                    tree[item] = []
+                for item in items:
+                    tree[int(item)] = []
             else:
-                #if it is not the last level
-                if unique_count[i] == self.patterns.shape[1]:
-                    #if it is the first level
-                    for item in levels[unique_count[i]]:
-                        tree[item] = levels[unique_count[i+1]]
-                else:
-                    #if it is not the first level
-                    for item in levels[unique_count[i]]:
-                        tree[item] = []
-                        for next_item in levels[unique_count[i+1]]:
-                            if -1 not in u_p[item] - u_p[next_item]:
-                                tree[item].append(next_item)
+                next_level = count_list == unique_count[i + 1]
+                for item in items:
+                    tree[int(item)] = np.flatnonzero(self._subset_matrix[item] & next_level).tolist()
         return tree
 
     def __str__(self):
@@ -79,58 +564,61 @@ class MissingPatterns:
     def _get_offsprings(self, node):
         if self._tree.get(node, None) is None:
             raise ValueError("The node does not exist")
-        else:
-            offsrpings = []
-            #breadth first search
-            #offsprings is all the nodes in the subtree of node except the node itself
-
-            queue = [node]
-            while len(queue) > 0:
-                curr_node = queue.pop(0)
-                offsrpings.append(curr_node)
-                if len(self._tree[curr_node]) > 0:
-                    queue += self._tree[curr_node]
-            offsrpings.remove(node)
-            return list(set(offsrpings))
+        #offsprings are all the patterns that are proper subsets of node
+        return np.flatnonzero(self._subset_matrix[node]).tolist()
 
     def _get_index_of_unique_pattern(self):
         unique_pattern_dict = {}
         for i in range(self.unique_patterns.shape[0]):
             unique_pattern_dict[tuple(self.unique_patterns[i])] = i
         return unique_pattern_dict
+
     def _get_pattern_groups(self):
-        #iterate through each row in self.patterns by index
-        #for each row, convert it to a tuple, use the tuple as key to get the value from the dictionary
-        #append the row index to the value
-        #return the dictionary
-        unique_pattern_dict = self._get_index_of_unique_pattern()
-        pattern_groups = {}
-        for i in range(self.patterns.shape[0]):
-            pattern = tuple(self.patterns[i])
-            pattern_index = unique_pattern_dict[pattern]
-            if pattern_groups.get(pattern_index, None) is None:
-                pattern_groups[pattern_index] = [i]
-            else:
-                pattern_groups[pattern_index].append(i)
-        return pattern_groups
+        '''
+        :return: a dictionary, the keys are the indexes of the unique patterns,
+        the values are np.ndarray of the indexes of the rows with that pattern
+        '''
+        order = np.argsort(self.pattern_index, kind='stable')
+        bounds = np.cumsum(np.bincount(self.pattern_index, minlength=self.unique_patterns.shape[0]))[:-1]
+        return dict(enumerate(np.split(order, bounds)))
 
 
 class DataFrameWithMissingValues:
-    def __init__(self, df, null_values):
+    def __init__(self, df, null_values, copy=True):
         '''
 
         :param df: pd.DataFrame
+        :param null_values: the values that are considered missing, whitespace-only strings are always missing
+        :param copy: if False, the missing values are replaced in df itself instead of in a copy of it
         '''
         self.missing_values = null_values
-        self.df = df
+        self.df = df if not copy else df.copy()
+        self._codes = None
+        self._cardinalities = None
         self._replace_missing_with_nan()
         self.missing_patterns = self._get_missing_patterns()
 
+    @classmethod
+    def from_encoded_table(cls, table, columns=None):
+        '''
+        build the group size computation directly on the codes of an EncodedTable,
+        the 'vectorized' and 'lattice_dp' algorithms can be used, 'dict' needs the original dataframe
+
+        :param table: EncodedTable
+        :param columns: the columns to group on, all the columns but id_column by default
+        '''
+        dm = cls.__new__(cls)
+        dm.missing_values = []
+        dm.df = None
+        dm._codes = table.codes_matrix(columns)
+        dm._cardinalities = table.cardinalities(columns)
+        if dm._codes.shape[0] == 0 or dm._codes.shape[1] == 0:
+            raise ValueError("The dataframe can not be empty")
+        dm.missing_patterns = MissingPatterns((dm._codes >= 0).astype(int))
+        return dm
+
     def _replace_missing_with_nan(self):
-        for i in range(self.df.shape[0]):
-            for j in range(self.df.shape[1]):
-                if self.df.iloc[i,j] in self.missing_values or str(self.df.iloc[i,j]).strip()== '':
-                    self.df.iloc[i,j] = np.nan
+        replace_missing_with_nan(self.df, self.missing_values, copy=False)
 
     def _get_missing_patterns(self):
         #check if the dataframe has anything in it
@@ -138,7 +626,37 @@ class DataFrameWithMissingValues:
             raise ValueError("The dataframe can not be empty")
         return MissingPatterns(np.array(pd.notnull(self.df)).astype(int))
 
-    def get_equivalent_group_size(self):
+    def _get_codes(self):
+        if self._codes is None:
+            self._codes, self._cardinalities = encode_columns(self.df)
+        return self._codes, self._cardinalities
+
+    def get_equivalent_group_size(self, algorithm=None, n_jobs=1):
+        '''
+        get the size of the equivalent group of each row, a missing value matches any value
+
+        :param algorithm: None, the default, runs 'vectorized' and returns a list, as the original implementation did,
+        'vectorized' joins packed integer codes of the known columns and returns a np.ndarray of int,
+        'lattice_dp' shares the projected counts across the pattern lattice and returns a np.ndarray of int,
+        'dict' walks the count dictionaries of the missing patterns and returns a list, it is kept as the reference
+        :param n_jobs: the number of worker processes the 'vectorized' algorithm spreads the patterns over
+        '''
+        if algorithm is None:
+            return self.get_equivalent_group_size('vectorized', n_jobs).tolist()
+        if algorithm == 'dict':
+            if self.df is None:
+                raise ValueError("the dict algorithm needs the original dataframe")
+            return self._get_equivalent_group_size_dict()
+        elif algorithm == 'vectorized':
+            codes, cardinalities = self._get_codes()
+            return get_equivalent_group_size_from_codes(codes, cardinalities, self.missing_patterns, n_jobs=n_jobs)
+        elif algorithm == 'lattice_dp':
+            codes, cardinalities = self._get_codes()
+            return get_equivalent_group_size_lattice_dp(codes, cardinalities, self.missing_patterns)
+        else:
+            raise ValueError("unknown algorithm: " + str(algorithm))
+
+    def _get_equivalent_group_size_dict(self):
         groups_by_missing = self.missing_patterns.pattern_groups
         u_p = self.missing_patterns.unique_patterns
         group_size = [0]*self.df.shape[0]
@@ -192,3 +710,179 @@ class DataFrameWithMissingValues:
                     group_size[i] = c_count_v[tuple(self.df.iloc[i, u_p[pattern_key] == 1])]
         return group_size
 
+
+class GroupSizeCache:
+    def __init__(self, max_bytes=256 * 2**20):
+        '''
+        a LRU cache of the equivalent group sizes of the rows of EncodedTable objects,
+        keyed by the table and the frozenset of the columns that are grouped on,
+        so the same projection is only computed once however many attacker combinations need it
+        :param max_bytes: the memory budget of the cached group size arrays, the least recently used
+        arrays are dropped when it is exceeded, an array larger than the budget is not cached
+        '''
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, table, columns, algorithm='vectorized', n_jobs=1):
+        '''
+        :param table: EncodedTable
+        :param columns: the columns to group on, the group size of every row is the number of rows
+        if there are no columns, a KeyError is raised if a column is not in table
+        :param algorithm: the algorithm of DataFrameWithMissingValues.get_equivalent_group_size
+        :return: read-only np.ndarray of float, the equivalent group size of every row of table
+        '''
+        missing = [col for col in columns if col not in table.columns]
+        if len(missing) > 0:
+            raise KeyError("the columns are not in the table: " + str(missing))
+        key = (id(table), frozenset(columns))
+        entry = self._cache.get(key, None)
+        if entry is not None and entry[0]() is table:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        if len(key[1]) == 0:
+            group_size = np.full(table.n_rows, float(table.n_rows))
+        else:
+            columns = [col for col in table.columns if col in key[1]]
+            group_size = np.asarray(DataFrameWithMissingValues.from_encoded_table(table, columns).
+                                    get_equivalent_group_size(algorithm, n_jobs), dtype=float)
+        group_size.setflags(write=False)
+        self._put(key, weakref.ref(table), group_size)
+        return group_size
+
+    def _put(self, key, table_ref, group_size):
+        if key in self._cache:
+            self.nbytes -= self._cache.pop(key)[1].nbytes
+        if group_size.nbytes > self.max_bytes:
+            return
+        self._cache[key] = (table_ref, group_size)
+        self.nbytes += group_size.nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._cache.popitem(last=False)[1][1].nbytes
+            self.evictions += 1
+
+    def __contains__(self, item):
+        '''
+        :param item: a tuple (table, columns)
+        '''
+        table, columns = item
+        entry = self._cache.get((id(table), frozenset(columns)), None)
+        return entry is not None and entry[0]() is table
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._cache), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+# the cache used by Risk unless another one is given
+GROUP_SIZE_CACHE = GroupSizeCache()
+
+
+def _encode_chunk(chunk, vocabularies, grow=True):
+    '''
+    encode the columns of a chunk with the codes in vocabularies, new values are appended
+    to the vocabularies if grow is True, otherwise they are encoded as -1
+    '''
+    codes = np.empty(chunk.shape, dtype=np.int64)
+    for j, col in enumerate(chunk.columns):
+        values = chunk[col]
+        if grow:
+            uniques = pd.unique(values.dropna())
+            new_values = uniques[~pd.Index(uniques).isin(vocabularies[j])]
+            if len(new_values) > 0:
+                vocabularies[j] = vocabularies[j].append(pd.Index(new_values))
+        codes[:, j] = vocabularies[j].get_indexer(values)
+    return codes
+
+
+def get_equivalent_group_size_chunked(dfile, output_file, columns=None, null_values=[], chunksize=100000,
+                                      sep=',', output='group_size', id_column=None, algorithm='vectorized'):
+    '''
+    compute the equivalent group size of every row of a csv file that does not fit in memory
+
+    the first pass reads the file in chunks and accumulates the counts of the distinct rows,
+    the second pass reads it again and writes the group size of every row to output_file,
+    so the memory used is bounded by the number of distinct rows, not the number of rows.
+    the values are compared as the strings in the file
+
+    :param dfile: the csv file
+    :param output_file: the csv file to write the group sizes to, one row per row in dfile
+    :param columns: the columns to group on, all the columns but id_column by default
+    :param null_values: the values that are considered missing
+    :param chunksize: the number of rows read at a time
+    :param output: 'group_size' writes the group size, 'risk' writes 1/group size
+    :param id_column: a column of dfile that is copied to output_file
+    :param algorithm: 'vectorized' or 'lattice_dp'
+    '''
+    if output not in ['group_size', 'risk']:
+        raise ValueError("unknown output: " + str(output))
+    if algorithm not in ['vectorized', 'lattice_dp']:
+        raise ValueError("unknown algorithm: " + str(algorithm))
+    null_values = [str(i) for i in null_values]
+    vocabularies = None
+    class_codes = None
+    class_counts = None
+    for chunk in pd.read_csv(dfile, sep=sep, usecols=columns, chunksize=chunksize, dtype=str, keep_default_na=False):
+        if vocabularies is None:
+            if columns is None:
+                columns = [c for c in chunk.columns if c != id_column]
+            vocabularies = [pd.Index([], dtype=object) for _ in columns]
+        chunk = chunk[columns]
+        chunk = replace_missing_with_nan(chunk, null_values)
+        codes = _encode_chunk(chunk, vocabularies)
+        counts = np.ones(codes.shape[0], dtype=np.int64)
+        if class_codes is not None:
+            codes = np.concatenate([class_codes, codes])
+            counts = np.concatenate([class_counts, counts])
+        class_codes, inverse = np.unique(codes, axis=0, return_inverse=True)
+        class_counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=class_codes.shape[0])
+        class_counts = np.rint(class_counts).astype(np.int64)
+    if class_codes is None:
+        raise ValueError("The dataframe can not be empty")
+
+    cardinalities = np.array([len(v) for v in vocabularies], dtype=np.int64)
+    missing_patterns = MissingPatterns((class_codes >= 0).astype(int))
+    if algorithm == 'vectorized':
+        class_sizes = get_equivalent_group_size_from_codes(class_codes, cardinalities, missing_patterns, class_counts)
+    else:
+        class_sizes = get_equivalent_group_size_lattice_dp(class_codes, cardinalities, missing_patterns, class_counts)
+
+    # the codes are shifted by one so that the missing values can be packed too
+    class_keys = _pack_keys(class_codes + 1, cardinalities + 1)
+    if class_keys is not None:
+        order = np.argsort(class_keys)
+        class_keys = class_keys[order]
+        class_sizes = class_sizes[order]
+
+    usecols = columns if id_column is None or id_column in columns else columns + [id_column]
+    header = True
+    for chunk in pd.read_csv(dfile, sep=sep, usecols=usecols, chunksize=chunksize, dtype=str, keep_default_na=False):
+        values = replace_missing_with_nan(chunk[columns], null_values)
+        codes = _encode_chunk(values, vocabularies, grow=False)
+        if class_keys is not None:
+            sizes = _lookup_counts(_pack_keys(codes + 1, cardinalities + 1), class_keys, class_sizes)
+        else:
+            keys, all_class_keys = _pack_keys_jointly([codes + 1, class_codes + 1], cardinalities + 1)
+            order = np.argsort(all_class_keys)
+            sizes = _lookup_counts(keys, all_class_keys[order], class_sizes[order])
+        out = pd.DataFrame(index=chunk.index)
+        if id_column is not None:
+            out[id_column] = chunk[id_column]
+        if output == 'group_size':
+            out['group_size'] = sizes
+        else:
+            out['risk'] = 1 / sizes
+        out.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+        header = False
@@ -1,8 +1,14 @@
 """
 author: Weiyi Xia
 """
+import numpy as np
+import pandas as pd
 from .attacker import Attacker
+from .attacker import BitmaskProbModel
+from .attacker import FactorizedProbModel
 from .dataset import Dataset
+from .groupsize import DataFrameWithMissingValues
+from .groupsize import GROUP_SIZE_CACHE
 
 def get_attacker_condition_fields_f(a_c_fields, a_c_fields_map, df_fields):
     '''
@@ -34,26 +40,95 @@ def get_attacker_condition_fields_f(a_c_fields, a_c_fields_map, df_fields):
             right = get_attacker_condition_fields_f(a_c_fields[1:],a_c_fields_map[1:],df_fields)
             return [left] + right
 
+def get_dataset_fields(attacker_known_fields_map, attacker_condition_fields_map=[]):
+    '''
+    the fields of the dataset that the risk computation uses, such as the usecols of Dataset
+    attacker_known_fields_map and attacker_condition_fields_map are the field maps of Risk,
+    a dictionary for one attacker, or a list of dictionaries, or of lists, for combined attackers
+    return the list of the fields in the order they first appear in the maps
+    '''
+    fields = []
+    for field_map in [attacker_known_fields_map, attacker_condition_fields_map]:
+        stack = [field_map]
+        while len(stack) > 0:
+            item = stack.pop(0)
+            if item is None:
+                continue
+            if type(item) is dict:
+                for field in item.values():
+                    if field not in fields:
+                        fields.append(field)
+            else:
+                stack = list(item) + stack
+    return fields
+
+
+class RangeMapping:
+    def __init__(self, ranges, sep):
+        '''
+        map numbers to the attacker condition values that represent ranges, e.g. '18-24' with sep '-'
+        a range 'lower-upper' covers lower <= value < upper, the ranges can not overlap
+        the boundaries are kept sorted so that a column is mapped with one np.searchsorted call
+        :param ranges: the attacker condition values, strings of the form lower + sep + upper
+        :param sep: the separator of the range
+        '''
+        bounds = []
+        for item in ranges:
+            if type(item) is not str:
+                raise ValueError("attacker condition field value is not a properly represented range")
+            elif item.count(sep) != 1:
+                raise ValueError("attacker condition field value is not a properly represented ranges")
+            lower, upper = item.split(sep)
+            bounds.append((int(lower), int(upper), item))
+        bounds.sort(key=lambda b: b[0])
+        self.lower = np.array([b[0] for b in bounds], dtype=np.int64)
+        self.upper = np.array([b[1] for b in bounds], dtype=np.int64)
+        self.labels = np.array([b[2] for b in bounds], dtype=object)
+        if np.any(self.upper[:-1] > self.lower[1:]):
+            raise ValueError("attacker condition field values are overlapping ranges")
+
+    def indices(self, values):
+        '''
+        :return: np.ndarray of int64, the index in self.labels of the range of every value, -1 if no range covers it
+        '''
+        values = pd.to_numeric(pd.Series(np.asarray(values, dtype=object)), errors='coerce').values.astype(float)
+        index = np.searchsorted(self.lower, values, side='right') - 1
+        covered = (index >= 0) & ~np.isnan(values)
+        covered[covered] = values[covered] < self.upper[index[covered]]
+        index[~covered] = -1
+        return index
+
+    def map(self, values):
+        '''
+        :return: np.ndarray of the range of every value, a KeyError is raised if a value is not in any range
+        '''
+        index = self.indices(values)
+        if np.any(index < 0):
+            raise KeyError(np.asarray(values, dtype=object)[np.argmax(index < 0)])
+        return self.labels[index]
+
+    def __getitem__(self, value):
+        return self.map([value])[0]
+
+    def __contains__(self, value):
+        return self.indices([value])[0] >= 0
+
+    def get(self, value, default=None):
+        return self[value] if value in self else default
+
+
 def get_attacker_condition_field_values_mapping(mapping_type, mapping_dict, map_to_range_sep = None, attacker_condition_field_values=None, values_in_ds = None):
     if mapping_type == 'use_range':
         if map_to_range_sep is None:
             raise ValueError("map to range separator is not specified")
         else:
-            c_dict = {}
-            for item in attacker_condition_field_values:
-                if type(item) is not str:
-                    raise ValueError("attacker condition field value is not a properly represented range")
-                elif item.count(map_to_range_sep) != 1:
-                    raise ValueError("attacker condition field value is not a properly represented ranges")
-                else:
-                    lower = int(item.split(map_to_range_sep)[0])
-                    upper = int(item.split(map_to_range_sep)[1])
-                    for value in range(lower, upper):
-                        c_dict[value] = item
-            for value in values_in_ds:
-                if value not in c_dict:
+            c_map = RangeMapping(attacker_condition_field_values, map_to_range_sep)
+            if values_in_ds is not None:
+                index = c_map.indices(values_in_ds)
+                if np.any(index < 0):
+                    value = np.asarray(values_in_ds, dtype=object)[np.argmax(index < 0)]
                     raise ValueError("value" + str(value) + " in ds are not attacker condition field values")
-            return c_dict
+            return c_map
     elif mapping_type == 'exact':
         for item in attacker_condition_field_values:
             if item not in attacker_condition_field_values:
@@ -113,7 +188,7 @@ def set_attacker_condition_fields_values_map_f(a_c_f_v_m_i, a_c_f_m, a_i, ds):
                 a_c_f_v_m_in_ds[k] = get_attacker_condition_field_values_mapping(m_type, m_map, range_sep, a_f_values, f_values_in_ds)
             return a_c_f_v_m_in_ds
         else:
-            return [set_attacker_condition_fields_values_map_f(a_c_f_v_m_i[0],a_c_f_m[0], a_i[0]), ds] + set_attacker_condition_fields_values_map_f(a_c_f_v_m_i[1:],a_c_f_m[1:],a_i[1:], ds)
+            return [set_attacker_condition_fields_values_map_f(a_c_f_v_m_i[0],a_c_f_m[0], a_i[0], ds)] + set_attacker_condition_fields_values_map_f(a_c_f_v_m_i[1:],a_c_f_m[1:],a_i[1:], ds)
 def get_prob_model_condition_key_f(a_c_f_i_d, a_c_f_v_m, df_row):
     '''
     recursive function to get the attacker model condition key
@@ -125,10 +200,10 @@ def get_prob_model_condition_key_f(a_c_f_i_d, a_c_f_v_m, df_row):
         return a_c_f_i_d
     else:
         curr_field = a_c_f_i_d[0]
-        if curr_field is str:
+        if type(curr_field) is str:
             c_v_in_ds = df_row[curr_field]
-            c_v_map = a_c_f_v_m[curr_field]
-            c_v_in_a_c = c_v_map[c_v_in_ds]
+            c_v_map = a_c_f_v_m.get(curr_field, None)
+            c_v_in_a_c = c_v_in_ds if c_v_map is None else c_v_map[c_v_in_ds]
             return [c_v_in_a_c] + get_prob_model_condition_key_f(a_c_f_i_d[1:],a_c_f_v_m,df_row)
         else:
             curr_a_c_f_i_d = curr_field
@@ -136,6 +211,68 @@ def get_prob_model_condition_key_f(a_c_f_i_d, a_c_f_v_m, df_row):
             left = get_prob_model_condition_key_f(curr_a_c_f_i_d,curr_a_c_f_v_m,df_row)
             right = get_prob_model_condition_key_f(a_c_f_i_d[1:],a_c_f_v_m[1:],df_row)
             return [left] + right
+def _is_single_condition_fields(a_c_f_i_d):
+    return all(type(item) is str for item in a_c_f_i_d)
+
+
+def get_condition_columns_f(a_c_f_i_d, a_c_f_v_m, df):
+    '''
+    recursive function to map the condition fields of all the rows at once
+    a_c_f_i_d is attacker_condition_fields_in_ds
+    a_c_f_v_m is attacker_condition_fields_values_map
+    df is the dataframe of the dataset
+    return a list of pd.Series, the attacker condition values of every condition field,
+    in the order of the fields in a_c_f_i_d
+    '''
+    if a_c_f_i_d is None or len(a_c_f_i_d)==0:
+        return []
+    if _is_single_condition_fields(a_c_f_i_d):
+        columns = []
+        for field in a_c_f_i_d:
+            c_v_map = a_c_f_v_m.get(field, None) if type(a_c_f_v_m) is dict else None
+            if c_v_map is None:
+                columns.append(df[field])
+            elif isinstance(c_v_map, RangeMapping):
+                columns.append(pd.Series(c_v_map.map(df[field].values), index=df.index))
+            else:
+                unmapped = ~df[field].isin(list(c_v_map.keys()))
+                if unmapped.any():
+                    raise KeyError(df[field][unmapped].iloc[0])
+                columns.append(df[field].map(c_v_map))
+        return columns
+    columns = []
+    for i, item in enumerate(a_c_f_i_d):
+        c_v_map = a_c_f_v_m[i] if a_c_f_v_m is not None and i < len(a_c_f_v_m) else None
+        columns += get_condition_columns_f(item, c_v_map, df)
+    return columns
+
+
+def get_prob_model_condition_key_from_values_f(a_c_f, values, flat_keys=False):
+    '''
+    recursive function to build the attacker model condition key from the condition values of a row
+    a_c_f is the attacker condition fields, Attacker.condition_fields or attacker_condition_fields_in_ds
+    values is an iterator of the condition values, in the order of the fields in a_c_f
+    flat_keys is Attacker.flat_keys
+    the keys are tuples of values for a single attacker, nested pairs for attackers combined with +,
+    and flat tuples for attackers combined with Attacker.combine
+    '''
+    if _is_single_condition_fields(a_c_f) or flat_keys:
+        key = ()
+        for item in a_c_f:
+            if type(item) is str:
+                key += (next(values),)
+            else:
+                key += get_prob_model_condition_key_from_values_f(item, values, True)
+        return key
+    left = get_prob_model_condition_key_from_values_f(a_c_f[0], values)
+    right = get_prob_model_condition_key_from_values_f(a_c_f[1], values)
+    if len(a_c_f[0]) == 0:
+        return right
+    if len(a_c_f[1]) == 0:
+        return left
+    return (left, right)
+
+
 class Risk:
     def __init__(
             self,
@@ -144,7 +281,8 @@ class Risk:
             attacker: Attacker,
             attacker_known_fields_map = [],
             attacker_condition_fields_map = [],
-            attacker_condition_fields_values_mapping_input = []
+            attacker_condition_fields_values_mapping_input = [],
+            group_size_cache = None
     ):
         self.dset = dset
         self.attacker_input = attacker_input
@@ -179,6 +317,9 @@ class Risk:
         self.attacker_condition_fields_values_mapping_input = attacker_condition_fields_values_mapping_input
         self.attacker_condition_fields_values_map = self.set_attacker_condition_fields_values_map()
         self.attacker_condition_fields_in_ds = self.get_attacker_condition_fields()
+        self.encoded_table = None
+        # the GroupSizeCache of the equivalent group sizes, shared by all the Risk objects by default
+        self.group_size_cache = GROUP_SIZE_CACHE if group_size_cache is None else group_size_cache
     def set_attacker_known_fields_map(self,a_k_f_map):
         '''
         a_k_f_map: a list of dictionary of known fields for each attacker
@@ -226,8 +367,24 @@ class Risk:
 
 
 
+    def get_encoded_table(self):
+        '''
+        the integer-coded table of the dataset that the group sizes are computed on
+        '''
+        if self.encoded_table is None:
+            self.encoded_table = self.dset.get_encoded_table()
+        return self.encoded_table
+
+    def get_equivalent_group_size(self, fields_in_ds, algorithm='vectorized'):
+        '''
+        fields_in_ds is a list of fields in the dataset
+        return the equivalent group size of every row of the dataset on these fields
+        '''
+        table = self.get_encoded_table()
+        return DataFrameWithMissingValues.from_encoded_table(table, fields_in_ds).get_equivalent_group_size(algorithm)
+
     def set_attacker_condition_fields_values_map(self):
-        set_attacker_condition_fields_values_map_f(self.attacker_condition_fields_values_mapping_input,self.attacker_condition_fields_map, self.attacker_input, self.dset)
+        return set_attacker_condition_fields_values_map_f(self.attacker_condition_fields_values_mapping_input,self.attacker_condition_fields_map, self.attacker_input, self.dset)
 
 
     def get_attacker_condition_fields(self):
@@ -242,9 +399,149 @@ class Risk:
         a_c_f_v_m = self.attacker_condition_fields_values_map
         return get_prob_model_condition_key_f(a_c_f_i_d,a_c_f_v_m,df_row)
 
-    def risk_metric(groupsize):
+    def get_condition_group_ids(self, df=None):
+        '''
+        map the condition fields of all the rows of df, the dataset by default, at once
+        return (group_ids, keys), group_ids is np.ndarray of int64, the condition group of every row,
+        keys is the list of the attacker model condition keys of the groups,
+        the rows of group i use the ProbModel self.attacker.model[keys[i]].
+        if the attacker model is not conditioned, every row is in group 0 and keys is [None]
+        '''
+        if df is None:
+            df = self.dset.dset
+        if not isinstance(self.attacker.model, dict):
+            return np.zeros(len(df), dtype=np.int64), [None]
+        columns = get_condition_columns_f(self.attacker_condition_fields_in_ds,
+                                          self.attacker_condition_fields_values_map, df)
+        values = pd.DataFrame({i: column.values for i, column in enumerate(columns)}, index=df.index)
+        grouped = values.groupby(list(values.columns), sort=True, dropna=False, observed=True)
+        group_ids = grouped.ngroup().values.astype(np.int64)
+        unique_values = grouped.size().index
+        if len(columns) == 1:
+            unique_values = [(v,) for v in unique_values]
+        keys = [get_prob_model_condition_key_from_values_f(self.attacker.condition_fields, iter(v), self.attacker.flat_keys)
+                for v in unique_values]
+        return group_ids, keys
+
+    def get_known_fields_patterns(self, model):
         '''
-        this function compute different risk metric based on group size
-        implement this function using pattern matching
+        project the combinations of an attacker ProbModel to the fields in the dataset,
+        the fields that are not in attacker_known_fields_map are dropped and
+        the combinations that project to the same fields are merged
+        return (fields_in_ds, patterns, prob_list), patterns is np.ndarray of bool,
+        one row per distinct set of known fields in the dataset, prob_list is the probability of each row
         '''
-        pass
+        if isinstance(model, BitmaskProbModel):
+            model = model.to_prob_model()
+        fields_in_ds = []
+        for field in model.fields:
+            field_in_ds = self.attacker_known_fields_map.get(field, None)
+            if field_in_ds is not None and field_in_ds not in fields_in_ds:
+                fields_in_ds.append(field_in_ds)
+        if isinstance(model, FactorizedProbModel):
+            patterns, prob_list = self.get_factorized_patterns(model, fields_in_ds)
+            return fields_in_ds, patterns, prob_list
+        projection = np.zeros((len(model.fields), len(fields_in_ds)), dtype=np.int64)
+        for i, field in enumerate(model.fields):
+            field_in_ds = self.attacker_known_fields_map.get(field, None)
+            if field_in_ds is not None:
+                projection[i, fields_in_ds.index(field_in_ds)] = 1
+        fields_array = np.asarray(model.fields_array, dtype=np.int64).reshape(len(model.prob_list), len(model.fields))
+        projected = (fields_array @ projection) > 0
+        patterns, inverse = np.unique(projected, axis=0, return_inverse=True)
+        prob_list = np.bincount(inverse.reshape(-1), weights=np.asarray(model.prob_list, dtype=float),
+                                minlength=len(patterns))
+        return fields_in_ds, patterns, prob_list
+
+    def get_factorized_patterns(self, model, fields_in_ds):
+        '''
+        the projection of a FactorizedProbModel to fields_in_ds, computed on the factors without enumerating
+        the combinations of the model: every factor is projected to the mask of the dataset fields it reveals,
+        and the factors are folded one at a time into the distribution over the masks,
+        which has at most 2 ** len(fields_in_ds) entries
+        return (patterns, prob_list), see get_known_fields_patterns
+        '''
+        distribution = {0: 1.0}
+        for factor, prob in zip(model.factor_fields, model.factor_probs):
+            mask = 0
+            for j in factor:
+                field_in_ds = self.attacker_known_fields_map.get(model.fields[j], None)
+                if field_in_ds is not None:
+                    mask |= 1 << fields_in_ds.index(field_in_ds)
+            if mask == 0 or prob == 0:
+                continue
+            folded = {}
+            for known, known_prob in distribution.items():
+                if prob < 1:
+                    folded[known] = folded.get(known, 0.0) + known_prob * (1 - prob)
+                folded[known | mask] = folded.get(known | mask, 0.0) + known_prob * prob
+            distribution = folded
+        masks = sorted(distribution.keys())
+        patterns = np.array([[(mask >> j) & 1 for j in range(len(fields_in_ds))] for mask in masks],
+                            dtype=bool).reshape(len(masks), len(fields_in_ds))
+        prob_list = np.array([distribution[mask] for mask in masks], dtype=float)
+        return patterns, prob_list
+
+    def get_group_size(self, fields_in_ds, algorithm='vectorized'):
+        '''
+        the equivalent group size of every row on the set of fields fields_in_ds,
+        the result is kept in self.group_size_cache, so every set of fields is only computed once
+        '''
+        return self.group_size_cache.get(self.get_encoded_table(), fields_in_ds, algorithm)
+
+    def risk_metric(self, metric='prosecutor', sampling_fraction=1.0, per_row=False, algorithm='vectorized'):
+        '''
+        compute the re-identification risk of the dataset against the attacker
+
+        the risk of a row is the expected value, over the combinations of known fields in the
+        attacker ProbModel of the row's condition group, of 1 / the equivalent group size of the row
+        on the known fields. a row whose condition group has no ProbModel is treated as
+        if the attacker knew none of its fields, so its group is the whole dataset.
+
+        :param metric: 'prosecutor', the attacker knows the target is in the dataset, the risk of a row
+        uses its group size in the dataset;
+        'journalist', the attacker does not know whether the target is in the dataset, the risk of a row
+        uses its group size in the population, estimated as the group size in the dataset / sampling_fraction;
+        'marketer', the expected proportion of the rows that are re-identified when the attacker
+        tries to match all the rows, the mean of the journalist risk of the rows
+        :param sampling_fraction: the fraction of the population that is in the dataset
+        :param per_row: if True, return np.ndarray of the risk of every row instead of the risk of the dataset
+        :param algorithm: the algorithm of DataFrameWithMissingValues.get_equivalent_group_size
+        :return: the maximum risk of the rows for prosecutor and journalist, the mean for marketer
+        '''
+        if metric not in ['prosecutor', 'journalist', 'marketer']:
+            raise ValueError("unknown risk metric: " + str(metric))
+        if not 0 < sampling_fraction <= 1:
+            raise ValueError("sampling_fraction should be in (0, 1]")
+        scale = 1.0 if metric == 'prosecutor' else sampling_fraction
+
+        group_ids, keys = self.get_condition_group_ids()
+        n_rows = len(group_ids)
+        order = np.argsort(group_ids, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(group_ids, minlength=len(keys)))])
+        risk = np.zeros(n_rows, dtype=float)
+        for g, key in enumerate(keys):
+            rows = order[bounds[g]:bounds[g + 1]]
+            if len(rows) == 0:
+                continue
+            if key is None:
+                model = self.attacker.model
+            else:
+                model = self.attacker.model.get(key, None)
+            if model is None:
+                risk[rows] = scale / n_rows
+                continue
+            fields_in_ds, patterns, prob_list = self.get_known_fields_patterns(model)
+            for pattern, prob in zip(patterns, prob_list):
+                if prob == 0:
+                    continue
+                known = [field for field, known in zip(fields_in_ds, pattern) if known]
+                risk[rows] += prob * scale / self.get_group_size(known, algorithm)[rows]
+
+        if per_row:
+            return risk
+        if n_rows == 0:
+            return 0.0
+        if metric == 'marketer':
+            return float(risk.mean())
+        return float(risk.max())
@@ -2,23 +2,23 @@
 author: Weiyi Xia
 last modified:  12/8/2022
 """
+from functools import lru_cache
 import numpy as np
 import pandas as pd
+@lru_cache(maxsize=32)
 def generate_all_binary_string(n):
     """
     Given a positive integer number N. The task is to generate all the binary strings of N bits.
     These binary strings should be in ascending order.
+    bit j of row i is (i >> j) & 1
+    the result is cached for each n and is read-only
     :param n:
-    :return an array:
+    :return an array of uint8:
     """
-    rows_count = 2**n
-    cols_count = n
-    binary_array = np.zeros((rows_count, cols_count))
-    for i in range(rows_count):
-        for j in range(cols_count):
-            if (i//(2**j))%2 == 1:
-                binary_array[i][j] = 1
-    return binary_array.astype(int)
+    rows = np.arange(2**n, dtype=np.int64)[:, None]
+    binary_array = ((rows >> np.arange(n, dtype=np.int64)) & 1).astype(np.uint8)
+    binary_array.setflags(write=False)
+    return binary_array
 def convert_2d_array_to_set(a):
     return set([tuple(i) for i in a])
 
@@ -2,8 +2,18 @@ import unittest
 from reidrisk.attacker import Attacker
 from reidrisk.attacker import joined_prob
 from reidrisk.attacker import ProbModel
+from reidrisk.attacker import FactorizedProbModel
+from reidrisk.attacker import BitmaskProbModel
+from reidrisk.attacker import FieldRegistry
+from reidrisk.attacker import PruningPolicy
+from reidrisk.attacker import add_two_prob_model
+from reidrisk.attacker import add_two_attacker_model
+from reidrisk.attacker import ProbModelSumCache
 import numpy as np
 import pandas as pd
+import tempfile
+import json
+import os
 
 class TestAttacker(unittest.TestCase):
     def test_joined_prob(self):
@@ -28,6 +38,18 @@ class TestAttacker(unittest.TestCase):
         self.assertEqual(np.array_equal(fields_array, np.array([[0],[1]])), True)
         self.assertEqual(np.array_equal(prob_list, np.array([0.5,0.5])), True)
 
+    def test_joined_prob_factorized(self):
+        field_list = ['age', 'race,gender', 'state']
+        prob_list = [0.5, 0.2, 1.0]
+        dense = joined_prob(field_list, prob_list)
+        prob_model = joined_prob(field_list, prob_list, factorized=True)
+        self.assertEqual(prob_model.fields, ['age','race','gender','state'])
+        self.assertEqual(len(prob_model), 4)
+        nonzero = dense.prob_list > 0
+        self.assertEqual(np.array_equal(prob_model.fields_array, dense.fields_array[nonzero]), True)
+        self.assertEqual(np.allclose(prob_model.prob_list, dense.prob_list[nonzero]), True)
+        self.assertEqual(np.allclose(prob_model.field_marginals(), [0.5, 0.2, 0.2, 1.0]), True)
+
     def test_add_two_prob_model_1(self):
         model1 = ProbModel(['age'],np.array([[0],[1]]),np.array([0.5,0.5]))
         model2 = None
@@ -40,6 +62,199 @@ class TestAttacker(unittest.TestCase):
         self.assertEqual(model3.fields, ['age', 'gender'])
         self.assertEqual(np.array_equal(model3.fields_array, np.array([[0,0],[0,1],[1,0],[1,1]])), True)
 
+    def test_add_two_prob_model_overlapping_fields(self):
+        model1 = ProbModel(['age','race'],np.array([[0,0],[1,0],[0,1]]),np.array([0.5,0.3,0.2]))
+        model2 = ProbModel(['race'],np.array([[0],[1]]),np.array([0.6,0.4]))
+        model3 = model1 + model2
+        self.assertEqual(model3.fields, ['age', 'race'])
+        self.assertEqual(np.array_equal(model3.fields_array, np.array([[0,0],[0,1],[1,0],[1,1]])), True)
+        self.assertEqual(np.allclose(model3.prob_list, [0.3, 0.2+0.2, 0.18, 0.12]), True)
+
+    def test_bitmask_prob_model(self):
+        registry = FieldRegistry()
+        model1 = ProbModel(['age','race'],np.array([[0,0],[1,0],[0,1]]),np.array([0.5,0.3,0.2])).to_bitmask(registry)
+        model2 = ProbModel(['race'],np.array([[0],[1]]),np.array([0.6,0.4])).to_bitmask(registry)
+        model3 = model1 + model2
+        self.assertEqual(model3.masks.dtype, np.uint64)
+        self.assertEqual(model3.fields, ['age', 'race'])
+        self.assertAlmostEqual(model3.lookup(['race']), 0.4)
+        self.assertAlmostEqual(model3.prob_known(['age']), 0.3)
+        self.assertEqual(np.allclose(model3.marginalize(['age']).prob_list, [0.7, 0.3]), True)
+        dense = model3.to_prob_model(['age', 'race'])
+        self.assertEqual(np.array_equal(dense.fields_array, np.array([[0,0],[1,0],[0,1],[1,1]])), True)
+
+    def test_add_two_prob_model_pruning(self):
+        model1 = ProbModel(['age'],np.array([[0],[1]]),np.array([0.9,0.1]))
+        model2 = ProbModel(['gender'],np.array([[0],[1]]),np.array([0.8,0.2]))
+        model3 = add_two_prob_model(model1, model2, PruningPolicy(epsilon=0.05))
+        self.assertEqual(np.array_equal(model3.fields_array, np.array([[0,0],[0,1],[1,0]])), True)
+        self.assertAlmostEqual(model3.discarded_mass, 0.02)
+        model4 = add_two_prob_model(model1, model2, PruningPolicy(top_k=1))
+        self.assertEqual(np.array_equal(model4.fields_array, np.array([[0,0]])), True)
+        self.assertAlmostEqual(model4.discarded_mass, 0.28)
+        model5 = add_two_prob_model(model3, model1)
+        self.assertAlmostEqual(model5.discarded_mass, 0.02)
+        self.assertAlmostEqual(model5.prob_list.sum() + model5.discarded_mass, 1.0)
+
+    def test_add_two_attacker_model_pruning(self):
+        attack1 = Attacker(pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=','))
+        attack2 = Attacker(pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=','))
+        combined = add_two_attacker_model(attack1, attack2, PruningPolicy(epsilon=0.01))
+        for model in combined.model.values():
+            self.assertEqual(np.all(model.prob_list >= 0.01), True)
+            self.assertAlmostEqual(model.prob_list.sum() + model.discarded_mass, 1.0)
+        self.assertGreater(combined.discarded_mass, 0)
+
+    def test_combine_attackers(self):
+        attack1 = Attacker(pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=','), name='a1')
+        attack2 = Attacker(pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=','), name='a2')
+        attack3 = Attacker(pd.DataFrame({'known_fields': ['ZIP'], 'probability': [0.3]}), name='a3')
+        combined = Attacker.combine([attack1, attack2, attack3])
+        chained = attack1 + attack2 + attack3
+        self.assertEqual(combined.name, 'a1 plus a2 plus a3')
+        self.assertEqual(combined.condition_fields, [['RACE', 'GENDER'], ['AGE_RANGE']])
+        self.assertEqual(combined.flat_keys, True)
+        self.assertEqual(len(combined.model), len(chained.model))
+        model = combined.model[('black', 'male', '18-24')]
+        expected = chained.model[(('black', 'male'), ('18-24',))]
+        self.assertEqual(model.fields, expected.fields)
+        self.assertEqual(np.array_equal(model.fields_array, expected.fields_array), True)
+        self.assertEqual(np.allclose(model.prob_list, expected.prob_list), True)
+
+    def test_add_factorized_attackers(self):
+        attack1 = Attacker(pd.DataFrame({'known_fields': ['F%d' % i for i in range(22)],
+                                         'probability': [0.5] * 22}), name='a1', factorized=True)
+        attack2 = Attacker(pd.DataFrame({'known_fields': ['G0', 'G1', 'G2'],
+                                         'probability': [0.2, 0.3, 0.4]}), name='a2', factorized=True)
+        for combined in [attack1 + attack2, Attacker.combine([attack1, attack2])]:
+            self.assertIsInstance(combined.model, FactorizedProbModel)
+            self.assertEqual(len(combined.model), 2 ** 25)
+            self.assertEqual(np.allclose(combined.model.field_marginals(), [0.5] * 22 + [0.2, 0.3, 0.4]), True)
+
+    def test_prob_model_sum_cache(self):
+        model1 = ProbModel(['age'],np.array([[0],[1]]),np.array([0.5,0.5]))
+        model2 = ProbModel(['age'],np.array([[0],[1]]),np.array([0.5,0.5]))
+        model3 = ProbModel(['gender'],np.array([[0],[1]]),np.array([0.2,0.8]))
+        self.assertEqual(model1.content_hash(), model2.content_hash())
+        self.assertNotEqual(model1.content_hash(), model3.content_hash())
+        cache = ProbModelSumCache(maxsize=1)
+        sum1 = cache.add(model1, model3)
+        sum2 = cache.add(model2, model3)
+        self.assertIs(sum1, sum2)
+        cache.add(model3, model1)
+        self.assertEqual(cache.cache_info(), {'hits': 1, 'misses': 2, 'size': 1, 'maxsize': 1})
+
+    def test_prob_model_sum_cache_factorized(self):
+        model1 = FactorizedProbModel(['age', 'race'], [[0], [1]], [0.5, 0.2])
+        model2 = FactorizedProbModel(['age', 'race'], [[0], [1]], [0.5, 0.2])
+        model3 = FactorizedProbModel(['age', 'race'], [[0, 1]], [0.5])
+        self.assertEqual(model1.content_hash(), model2.content_hash())
+        self.assertNotEqual(model1.content_hash(), model3.content_hash())
+        cache = ProbModelSumCache()
+        sum1 = cache.add(model1, model3)
+        self.assertIsInstance(sum1, FactorizedProbModel)
+        self.assertIs(cache.add(model2, model3), sum1)
+        self.assertEqual(cache.cache_info()['hits'], 1)
+
+    def test_add_two_attacker_model_cache(self):
+        attack1 = Attacker(pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=','))
+        attack2 = Attacker(pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=','))
+        cache = ProbModelSumCache()
+        add_two_attacker_model(attack1, attack2, cache=cache)
+        info = cache.cache_info()
+        self.assertEqual(info['hits'] + info['misses'], len(attack1.model) * len(attack2.model))
+        self.assertGreater(info['hits'], 0)
+
+    def test_create_attacker_model_same_as_joined_prob(self):
+        attack2_df = pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=',')
+        attack2 = Attacker(attack2_df)
+        for key, model in attack2.model.items():
+            group = attack2_df[attack2_df['AGE_RANGE'] == key[0]]
+            expected = joined_prob(group['known_fields'].tolist(), group['probability'].tolist())
+            self.assertEqual(model.fields, expected.fields)
+            self.assertEqual(np.array_equal(model.fields_array, expected.fields_array), True)
+            self.assertEqual(np.array_equal(model.prob_list, expected.prob_list), True)
+
+    def test_create_attacker_model_overlap(self):
+        attack_df = pd.DataFrame({'RACE': ['white', 'white', 'black'],
+                                  'known_fields': ['AGE,RACE', 'AGE,GENDER', 'AGE'],
+                                  'probability': [0.5, 0.2, 0.1]})
+        with self.assertRaises(ValueError):
+            Attacker(attack_df)
+
+    def test_save_load_attacker(self):
+        attack1 = Attacker(pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=','))
+        attack2 = Attacker(pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=','))
+        combined = Attacker.combine([attack1, attack2], pruning=PruningPolicy(epsilon=0.01))
+        with tempfile.TemporaryDirectory() as path:
+            combined.save(path)
+            loaded = Attacker.load(path)
+            self.assertEqual(loaded.condition_fields, combined.condition_fields)
+            self.assertEqual(loaded.flat_keys, True)
+            self.assertEqual(list(loaded.model.keys()), list(combined.model.keys()))
+            for key, model in combined.model.items():
+                self.assertEqual(loaded.model[key].fields, model.fields)
+                self.assertEqual(loaded.model[key].content_hash(), model.content_hash())
+            self.assertEqual(loaded.discarded_mass, combined.discarded_mass)
+            bitmask = Attacker.load(path, bitmask=True)
+            key = ('black', 'male', '18-24')
+            self.assertAlmostEqual(bitmask.model[key].prob_known(['AGE']),
+                                   combined.model[key].to_bitmask().prob_known(['AGE']))
+            del loaded, bitmask
+            with open(os.path.join(path, 'attacker.json')) as f:
+                meta = json.load(f)
+            meta['version'] = 2
+            with open(os.path.join(path, 'attacker.json'), 'w') as f:
+                json.dump(meta, f)
+            with self.assertRaises(ValueError):
+                Attacker.load(path)
+
+    def test_bitmask_prob_model_own_registry(self):
+        models = [ProbModel(['field%d' % i], np.array([[0], [1]]), np.array([0.5, 0.5])).to_bitmask() for i in range(100)]
+        self.assertEqual(len(models[99].registry), 1)
+        model_sum = models[0] + models[1]
+        self.assertEqual(model_sum.registry, models[0].registry)
+        self.assertAlmostEqual(model_sum.prob_known(['field0', 'field1']), 0.25)
+        self.assertAlmostEqual(model_sum.lookup(['field1']), 0.25)
+
+    def test_save_load_attacker_many_fields(self):
+        attack_df = pd.DataFrame({'known_fields': [','.join('F%d_%d' % (i, j) for j in range(10)) for i in range(7)],
+                                  'probability': [0.1 * (i + 1) for i in range(7)]})
+        attacker = Attacker(attack_df)
+        self.assertEqual(len(attacker.model.fields), 70)
+        with tempfile.TemporaryDirectory() as path:
+            attacker.save(path)
+            loaded = Attacker.load(path)
+            self.assertEqual(loaded.model.fields, attacker.model.fields)
+            self.assertEqual(loaded.model.content_hash(), attacker.model.content_hash())
+            with self.assertRaises(ValueError):
+                Attacker.load(path, bitmask=True)
+            del loaded
+
+    def test_load_bitmask_attacker_combine_save(self):
+        attack1 = Attacker(pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=','))
+        attack2 = Attacker(pd.read_csv('script/attacker2.csv', header=0, index_col=None, sep=','))
+        combined = Attacker.combine([attack1, attack2], pruning=PruningPolicy(epsilon=0.01))
+        key = ('black', 'male', '18-24')
+        with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as path2:
+            combined.save(path)
+            bitmask = Attacker.load(path, bitmask=True)
+            self.assertIsInstance(bitmask.model[key], BitmaskProbModel)
+            self.assertEqual(bitmask.model[key].discarded_mass, combined.model[key].discarded_mass)
+            nested = (bitmask + attack1).model[(key, ('black', 'male'))]
+            expected = (combined + attack1).model[(key, ('black', 'male'))]
+            self.assertAlmostEqual(nested.to_bitmask().prob_known(['AGE', 'STATE']),
+                                   expected.to_bitmask().prob_known(['AGE', 'STATE']))
+            flat = Attacker.combine([attack1, bitmask]).model[('black', 'male') + key]
+            expected = Attacker.combine([attack1, combined]).model[('black', 'male') + key]
+            self.assertAlmostEqual(flat.to_bitmask().prob_known(['AGE', 'STATE']),
+                                   expected.to_bitmask().prob_known(['AGE', 'STATE']))
+            bitmask.save(path2)
+            loaded = Attacker.load(path2)
+            self.assertEqual(loaded.model[key].discarded_mass, combined.model[key].discarded_mass)
+            self.assertEqual(set(loaded.model[key].fields), set(combined.model[key].fields))
+            del bitmask, loaded
+
     def test_create_attacker_model1(self):
         attack1_df = pd.read_csv('script/attacker1.csv', header=0, index_col=None, sep=',')
         attack1 = Attacker(attack1_df)
@@ -1,6 +1,13 @@
 import unittest
 from reidrisk.dataset import Dataset
+from reidrisk.dataset import combine
+from reidrisk.dataset import generalize_birth_year
+from reidrisk.dataset import generalize_years
+import numpy as np
 import pandas as pd
+import os
+import tempfile
+from unittest import mock
 
 DATAFILE = 'data/synthetic_data_small.csv'
 DATAFILE2 = 'data/AoU_DM_2000.csv'
@@ -35,6 +42,83 @@ class TestDataset(unittest.TestCase):
         ds = Dataset(source='file', dfile=DATAFILE2, null_value_list=null_value_l, data_model=datamodel, multi_select_field_values = values_dict, year_bin=2)
         ds.combine_multi_select_answers()
         ds.dset.to_csv('data/AoU_DM_2000_combine_multi_select.csv', index=False)
+    def test_combine_multiselect_same_as_combine(self):
+        df = pd.DataFrame({'q_a': ['a', '', 'a', np.nan, 'a'],
+                           'q_b': ['b', 'b', np.nan, np.nan, ''],
+                           'q_skip': ['skip', np.nan, 'skip', 'skip', np.nan],
+                           'q_c': ['c', 'c', np.nan, np.nan, 'c'],
+                           'other': [1, 2, 3, 4, 5]})
+        expected = [combine([row['q_a'], row['q_b'], row['q_c']]) for _, row in df.iterrows()]
+        ds = Dataset(source='dataframe', dset=df, null_value_list=['skip'],
+                     multi_select_field_values={'q': ['a', 'b', 'skip', 'c']})
+        ds.combine_multi_select_answers()
+        self.assertEqual(list(ds.columns), ['other', 'q'])
+        self.assertEqual(ds.dset['q'].tolist(), expected)
+        self.assertEqual(expected, ['a and b and c', 'b and c', 'a', '', 'a and c'])
+    def test_generalize_years(self):
+        values = [1990, '1991-05-02', 1987.0, '2001', '19', '', 'abcd']
+        expected = [generalize_birth_year(v, 5) for v in values[:5]] + ['', '']
+        self.assertEqual(list(generalize_years(values, 5)), expected)
+        self.assertEqual(list(generalize_years(values + [np.nan, None], 5)), expected + ['', ''])
+        self.assertEqual(list(generalize_years(values, bin_edges=[1900, 1990, 2000])),
+                         ['1990', '1990', '1900', '', '', '', ''])
+    def test_generalize_year(self):
+        df = pd.DataFrame({'year_of_birth': [1990, 1993, np.nan], 'death_date': ['2020-01-05', np.nan, '2013-07-01']})
+        ds = Dataset(source='dataframe', dset=df, year_bin=5)
+        ds.create_year_of_death_column()
+        ds.generalize_year()
+        self.assertEqual(ds.dset['year_of_birth'].tolist(), ['1990', '1990', ''])
+        self.assertEqual(ds.dset['year_of_death'].tolist(), ['2020', '', '2010'])
+    def test_convert_cate_to_numeric(self):
+        df = pd.DataFrame({'race': ['white', '', 'black', 'white'], 'age': [30, 40, 30, 50]})
+        ds = Dataset(source='dataframe', dset=df, vocabularies={'race': ['white']})
+        ds.convert_cate_to_numeric()
+        self.assertEqual(ds.dset_numeric['race'].tolist(), [0, -1, 1, 0])
+        self.assertEqual(ds.dset_numeric['age'].tolist(), [0, 1, 0, 2])
+        self.assertEqual(ds.categories_dict['race'], {0: 'white', 1: 'black'})
+        self.assertEqual(ds.null_df['race'].tolist(), [False, True, False, False])
+        self.assertEqual(ds.dset['race'].tolist(), ['white', '', 'black', 'white'])
+    def test_pipeline_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold = Dataset(source='file', dfile=DATAFILE, null_value_list=['Skip'], cache_dir=cache_dir)
+            dset_numeric, null_df, categories_dict = cold.pipeline()
+            with mock.patch('pandas.read_csv') as read_csv:
+                warm = Dataset(source='file', dfile=DATAFILE, null_value_list=['Skip'], cache_dir=cache_dir)
+                self.assertIsNone(warm._dset_numeric)
+                self.assertIsNone(warm._null_df)
+                self.assertEqual(np.shares_memory(warm.dset_numeric['race'].values,
+                                                  warm.encoded_table.codes['race']), True)
+                warm_numeric, warm_null_df, warm_categories = warm.pipeline()
+                read_csv.assert_not_called()
+            self.assertEqual(warm_numeric.equals(dset_numeric), True)
+            self.assertEqual(warm_null_df.equals(null_df), True)
+            self.assertEqual(warm_categories, categories_dict)
+            self.assertEqual(list(warm.columns), list(cold.columns))
+            self.assertEqual(warm.dset['race'].tolist(), cold.dset['race'].tolist())
+            other = Dataset(source='file', dfile=DATAFILE, null_value_list=['Skip'], cache_dir=cache_dir, year_bin=2)
+            self.assertNotEqual(other.cache_path, warm.cache_path)
+            self.assertIsNone(other.dset_numeric)
+            del warm
+    def test_usecols_dtype(self):
+        ds = Dataset(source='file', dfile=DATAFILE, usecols=['state', 'race', 'age'], dtype='infer')
+        self.assertEqual(list(ds.columns), ['race', 'age', 'state'])
+        self.assertEqual(str(ds.dset['race'].dtype), 'category')
+        self.assertEqual(ds.dset['age'].dtype, np.int64)
+        full = Dataset(source='file', dfile=DATAFILE)
+        self.assertEqual(ds.dset['race'].astype(object).tolist(), full.dset['race'].tolist())
+        with self.assertRaises(ValueError):
+            Dataset(source='file', dfile=DATAFILE, usecols=['race', 'no_such_column'])
+    def test_usecols_multiselect(self):
+        df = pd.DataFrame({'q_a': ['a', '', 'a'], 'q_b': ['b', 'b', ''], 'r_a': ['a', 'a', 'a'], 'age': [1, 2, 3]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dfile = os.path.join(tmp_dir, 'data.csv')
+            df.to_csv(dfile, index=False)
+            ds = Dataset(source='file', dfile=dfile, usecols=['q', 'age'], dtype='infer', engine='python',
+                         multi_select_field_values={'q': ['a', 'b'], 'r': ['a']})
+        self.assertEqual(list(ds.columns), ['q_a', 'q_b', 'age'])
+        ds.combine_multi_select_answers()
+        self.assertEqual(list(ds.columns), ['age', 'q'])
+        self.assertEqual(ds.dset['q'].tolist(), ['a and b', 'b', 'a'])
     def test_default_pipeline(self):
         """
         this test case can be moved to a Jupyter notebook as a demonstration
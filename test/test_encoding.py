@@ -0,0 +1,73 @@
+import unittest
+from reidrisk.encoding import EncodedTable
+from reidrisk.encoding import encode_column
+from reidrisk.groupsize import DataFrameWithMissingValues
+from reidrisk.dataset import Dataset
+import pandas as pd
+import numpy as np
+import tempfile
+
+DATAFILE = 'data/synthetic_data_small.csv'
+
+class TestEncoding(unittest.TestCase):
+    def test_from_dataframe(self):
+        df = pd.DataFrame({'race': ['white', 'black', 'Skip', 'white'], 'age': [30, 40, 30, np.nan]})
+        table = EncodedTable.from_dataframe(df, ['Skip'])
+        self.assertEqual(table.codes['race'].dtype, np.int8)
+        self.assertEqual(table.codes['race'].tolist(), [1, 0, -1, 1])
+        self.assertEqual(table.categories['race'], {0: 'black', 1: 'white'})
+        self.assertEqual(table.is_null('race').tolist(), [False, False, True, False])
+        self.assertEqual(table.is_null('age').tolist(), [False, False, False, True])
+        self.assertEqual(table.null_mask.shape, (2, 1))
+        self.assertEqual(table.decode()['race'].tolist()[:2], ['white', 'black'])
+        self.assertEqual(df['race'].tolist(), ['white', 'black', 'Skip', 'white'])
+
+    def test_encode_column(self):
+        codes, categories = encode_column(np.array(['b', 'a', '', ' ', 'Skip', np.nan, 'c'], dtype=object), ['Skip'])
+        self.assertEqual(codes.tolist(), [1, 0, -1, -1, -1, -1, 2])
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertEqual(categories, ['a', 'b', 'c'])
+        codes, categories = encode_column(np.array(['b', 'a', 'd', 'c'], dtype=object), None, ['c', 'b', 'a'])
+        self.assertEqual(codes.tolist(), [1, 2, 3, 0])
+        self.assertEqual(categories, ['c', 'b', 'a', 'd'])
+
+    def test_from_dataframe_vocabularies(self):
+        january = pd.DataFrame({'race': ['white', 'black', ''], 'state': ['TN', 'AK', 'AK']})
+        february = pd.DataFrame({'race': ['asian', 'white', 'black'], 'state': ['AK', 'TN', 'TN']})
+        table1 = EncodedTable.from_dataframe(january, [''])
+        table2 = EncodedTable.from_dataframe(february, [''], table1.vocabularies())
+        self.assertEqual(table2.codes['race'].tolist(), [2, 1, 0])
+        self.assertEqual(table2.categories['race'], {0: 'black', 1: 'white', 2: 'asian'})
+        self.assertEqual(table2.codes['state'].tolist(), [0, 1, 1])
+        self.assertEqual(table2.decode().values.tolist(), february.values.tolist())
+
+    def test_save_load(self):
+        df = pd.DataFrame({'race': ['white', 'black', 'Skip', 'white'], 'age': [30, 40, 30, np.nan]})
+        table = EncodedTable.from_dataframe(df, ['Skip'])
+        with tempfile.TemporaryDirectory() as path:
+            table.save(path)
+            loaded = EncodedTable.load(path)
+            self.assertEqual(loaded.columns, table.columns)
+            self.assertEqual(loaded.categories, table.categories)
+            for col in table.columns:
+                self.assertEqual(loaded.codes[col].dtype, table.codes[col].dtype)
+                self.assertEqual(loaded.codes[col].tolist(), table.codes[col].tolist())
+            self.assertEqual(loaded.null_df().values.tolist(), table.null_df().values.tolist())
+            self.assertEqual(loaded.decode(null_value='')['race'].tolist(), ['white', 'black', '', 'white'])
+            del loaded
+
+    def test_group_size_from_encoded_table(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(rng.integers(0, 4, size=(200, 3)), columns=['a', 'b', 'c'])
+        table = EncodedTable.from_dataframe(df, [0])
+        expected = DataFrameWithMissingValues(df, [0]).get_equivalent_group_size(algorithm='dict')
+        dm = DataFrameWithMissingValues.from_encoded_table(table)
+        self.assertEqual(dm.get_equivalent_group_size(algorithm='vectorized').tolist(), expected)
+
+    def test_dataset_encoded_table(self):
+        ds = Dataset(source='file', dfile=DATAFILE)
+        ds.pipeline()
+        table = ds.get_encoded_table()
+        self.assertEqual(table.columns, list(ds.columns))
+        self.assertEqual(table.null_df().values.tolist(), ds.null_df.values.tolist())
+        self.assertLess(table.nbytes, ds.dset.memory_usage(deep=True).sum())
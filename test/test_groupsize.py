@@ -1,6 +1,12 @@
+import os
+import tempfile
 import unittest
+import warnings
 from reidrisk.groupsize import MissingPatterns
 from reidrisk.groupsize import DataFrameWithMissingValues
+from reidrisk.groupsize import get_equivalent_group_size_chunked
+from reidrisk.groupsize import GroupSizeCache
+from reidrisk.encoding import EncodedTable
 from reidrisk.utils import convert_2d_array_to_set
 import pandas as pd
 import numpy as np
@@ -71,3 +77,128 @@ class TestGroupsize(unittest.TestCase):
         mp = DataFrameWithMissingValues(pd.DataFrame(patterns), [0])
         counts = mp.get_equivalent_group_size()
         self.assertEqual(counts, [2, 7, 3, 5, 3, 3, 3, 4, 2])
+
+    def test_equivalent_group_size_vectorized(self):
+        patterns = np.array([
+            [0,0,0],
+            [8,100,90],
+            [0,0,90],
+            [8,0,90],
+            [0,100,0],
+            [0,0,13],
+            [8,0,0],
+            [0,100,65],
+            [0,0,0]])
+        mp = DataFrameWithMissingValues(pd.DataFrame(patterns), [0])
+        counts = mp.get_equivalent_group_size(algorithm='vectorized')
+        self.assertEqual(counts.tolist(), [2, 7, 3, 5, 3, 3, 3, 4, 2])
+
+    def test_equivalent_group_size_vectorized_same_as_dict(self):
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 4, size=(300, 4))
+        mp = DataFrameWithMissingValues(pd.DataFrame(values), [0])
+        self.assertEqual(mp.get_equivalent_group_size(algorithm='vectorized').tolist(), mp.get_equivalent_group_size(algorithm='dict'))
+
+    def test_replace_missing_with_nan(self):
+        df = pd.DataFrame({'a': [1, 0, 3], 'b': ['x', ' ', 'Skip'], 'c': ['y', 3, '']})
+        dm = DataFrameWithMissingValues(df, [0, 'Skip'])
+        self.assertEqual(dm.df.isnull().values.tolist(),
+                         [[False, False, False], [True, True, False], [False, True, True]])
+        self.assertEqual(df['b'].tolist(), ['x', ' ', 'Skip'])
+        DataFrameWithMissingValues(df, [0, 'Skip'], copy=False)
+        self.assertTrue(pd.isnull(df.loc[2, 'b']))
+
+    def test_replace_missing_with_nan_without_strings(self):
+        df = pd.DataFrame({'a': [1, 2, 1], 'b': [1, 2, 1]}).astype(object)
+        dm = DataFrameWithMissingValues(df, ['Skip'])
+        self.assertEqual(dm.df.isnull().values.tolist(), [[False, False]] * 3)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(dm.get_equivalent_group_size(), [2, 1, 2])
+        df = pd.DataFrame({'c': pd.Categorical(['x', ' ', 'Skip', 'x'])})
+        dm = DataFrameWithMissingValues(df, ['Skip'])
+        self.assertEqual(dm.df['c'].isnull().tolist(), [False, True, True, False])
+
+    def test_MissingPatterns_offsprings_across_levels(self):
+        patterns = np.array([[1,1,1,0],[0,0,1,1],[1,0,0,0]])
+        mp = MissingPatterns(patterns)
+        #[1,0,0,0] is a subset of [1,1,1,0] even though no pattern with two known columns links them
+        #the unique patterns are sorted: [0,0,1,1], [1,0,0,0], [1,1,1,0]
+        self.assertEqual(mp._get_offsprings(2), [1])
+        self.assertEqual(mp.linked_patterns[2].tolist(), [1])
+        self.assertEqual(mp.offspring_indptr.tolist(), [0, 0, 0, 1])
+        self.assertEqual(mp.pattern_masks[:, 0].tolist(), [12, 1, 7])
+
+    def test_equivalent_group_size_lattice_dp(self):
+        rng = np.random.default_rng(1)
+        values = rng.integers(0, 3, size=(300, 5))
+        mp = DataFrameWithMissingValues(pd.DataFrame(values), [0])
+        self.assertEqual(mp.get_equivalent_group_size(algorithm='lattice_dp').tolist(), mp.get_equivalent_group_size(algorithm='dict'))
+
+    def test_equivalent_group_size_lattice_dp_wide(self):
+        # the keys of 60 columns do not fit in int64, so they are packed in blocks
+        rng = np.random.default_rng(4)
+        values = rng.integers(1, 5, size=(20, 60))[rng.integers(0, 20, size=300)]
+        values[:, :5][rng.random((300, 5)) < 0.3] = 0
+        mp = DataFrameWithMissingValues(pd.DataFrame(values), [0])
+        self.assertEqual(mp.get_equivalent_group_size(algorithm='lattice_dp').tolist(), mp.get_equivalent_group_size(algorithm='dict'))
+
+    def test_equivalent_group_size_chunked(self):
+        rng = np.random.default_rng(2)
+        df = pd.DataFrame(rng.integers(0, 3, size=(200, 3)), columns=['a', 'b', 'c'])
+        df['id'] = range(200)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dfile = os.path.join(tmp_dir, 'data.csv')
+            output_file = os.path.join(tmp_dir, 'group_size.csv')
+            df.to_csv(dfile, index=False)
+            get_equivalent_group_size_chunked(dfile, output_file, columns=['a', 'b', 'c'], null_values=[0],
+                                              chunksize=64, id_column='id')
+            result = pd.read_csv(output_file)
+        expected = DataFrameWithMissingValues(df[['a', 'b', 'c']], [0]).get_equivalent_group_size(algorithm='dict')
+        self.assertEqual(result['id'].tolist(), list(range(200)))
+        self.assertEqual(result['group_size'].tolist(), expected)
+
+    def test_equivalent_group_size_chunked_default_columns(self):
+        rng = np.random.default_rng(3)
+        df = pd.DataFrame(rng.integers(0, 3, size=(200, 3)), columns=['a', 'b', 'c'])
+        df.insert(0, 'id', range(200))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dfile = os.path.join(tmp_dir, 'data.csv')
+            output_file = os.path.join(tmp_dir, 'group_size.csv')
+            df.to_csv(dfile, index=False)
+            get_equivalent_group_size_chunked(dfile, output_file, null_values=[0], chunksize=64, id_column='id')
+            result = pd.read_csv(output_file)
+        expected = DataFrameWithMissingValues(df[['a', 'b', 'c']], [0]).get_equivalent_group_size()
+        self.assertEqual(result['id'].tolist(), list(range(200)))
+        self.assertEqual(result['group_size'].tolist(), expected)
+
+    def test_equivalent_group_size_parallel(self):
+        rng = np.random.default_rng(3)
+        values = rng.integers(0, 3, size=(300, 4))
+        mp = DataFrameWithMissingValues(pd.DataFrame(values), [0])
+        self.assertEqual(mp.get_equivalent_group_size(algorithm='vectorized', n_jobs=2).tolist(),
+                         mp.get_equivalent_group_size(algorithm='vectorized').tolist())
+
+    def test_group_size_cache(self):
+        rng = np.random.default_rng(4)
+        df = pd.DataFrame(rng.integers(0, 3, size=(100, 3)), columns=['a', 'b', 'c'])
+        table = EncodedTable.from_dataframe(df, [0])
+        # room for two arrays of 100 float64
+        cache = GroupSizeCache(max_bytes=1600)
+        group_size = cache.get(table, ['b', 'a'])
+        expected = DataFrameWithMissingValues(df[['a', 'b']], [0]).get_equivalent_group_size(algorithm='dict')
+        self.assertEqual(group_size.tolist(), expected)
+        self.assertIs(cache.get(table, ['a', 'b']), group_size)
+        self.assertEqual(cache.get(table, []).tolist(), [100.0] * 100)
+        cache.get(table, ['c'])
+        info = cache.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['evictions'], info['size']), (1, 3, 1, 2))
+        self.assertEqual(info['nbytes'], 1600)
+        self.assertNotIn((table, ['a', 'b']), cache)
+        self.assertIn((table, ['c']), cache)
+        other = EncodedTable.from_dataframe(df, [0])
+        self.assertNotIn((other, ['c']), cache)
+        with self.assertRaises(KeyError):
+            cache.get(table, ['a', 'typo'])
+        with self.assertRaises(KeyError):
+            cache.get(table, ['typo'])
@@ -6,11 +6,21 @@ import pandas as pd
 from reidrisk.risk import get_attacker_condition_fields_f
 from reidrisk.risk import get_attacker_condition_field_values_mapping
 from reidrisk.risk import set_attacker_condition_fields_values_map_f
+from reidrisk.risk import RangeMapping
+from reidrisk.risk import get_dataset_fields
+from reidrisk.groupsize import GroupSizeCache
+import numpy as np
 
 
 DATAFILE = 'data/synthetic_data_small.csv'
 ATTACKERFILE1 = 'script/attacker1.csv'
 ATTACKERFILE2 = 'script/attacker2.csv'
+RACE_DICT = {'What Race Ethnicity: Black':'black', 'What Race Ethnicity: White':'white', 'Skip':'other',
+ 'What Race Ethnicity: Hispanic':'other', 'What Race Ethnicity: Asian':'other', 'Other':'other',
+ 'More than one race/ethnicity':'other', 'Prefer Not To Answer':'other'}
+GENDER_DICT = {'Gender Identity: Man':'male', 'Gender Identity: Woman':'female', 'Skip':'other',
+ 'Gender Identity: Non Binary':'other', 'Gender Identity: Transgender':'other',
+ 'Gender Identity: Additional Options' :'other', 'Prefer Not To Answer':'other'}
 
 class TestRisk(unittest.TestCase):
     def test_set_attacker_known_fields_map(self):
@@ -51,6 +61,11 @@ class TestRisk(unittest.TestCase):
         a_c_fields_in_d = get_attacker_condition_fields_f(a_c_fields, a_c_fields_map, df_fields)
         self.assertEqual(a_c_fields_in_d, [['race','age'],['age']])
 
+    def test_get_dataset_fields(self):
+        a_known_f_m = [{'RACE':'race','GENDER':'gender'}, {'AGE':'age','RACE':'race'}]
+        a_c_f_m = [[{'RACE':'race'}, {'STATE':'state'}], {'AGE_RANGE':'age'}]
+        self.assertEqual(get_dataset_fields(a_known_f_m, a_c_f_m), ['race', 'gender', 'age', 'state'])
+        self.assertEqual(get_dataset_fields({'AGE':'age'}), ['age'])
     def test_get_attacker_condition_field_values_mapping_1(self):
         mapping_type = 'use_range'
         map_to_range_sep = '-'
@@ -65,6 +80,24 @@ class TestRisk(unittest.TestCase):
         self.assertEqual(a[9], '1-10')
         self.assertEqual(a[10], '10-20')
         self.assertEqual(a[19], '10-20')
+    def test_get_attacker_condition_field_values_mapping_2(self):
+        attacker_condition_field_values = ['0-1000000000', '1000000000-2000000000']
+        a = get_attacker_condition_field_values_mapping('use_range', None, '-', attacker_condition_field_values, [0, 999999999, 1000000000])
+        self.assertEqual(list(a.map([5, 1999999999, 1000000000])), ['0-1000000000', '1000000000-2000000000', '1000000000-2000000000'])
+        with self.assertRaises(ValueError):
+            get_attacker_condition_field_values_mapping('use_range', None, '-', attacker_condition_field_values, [1, 2000000000])
+        with self.assertRaises(ValueError):
+            get_attacker_condition_field_values_mapping('use_range', None, '-', ['1-10', '10'], [1])
+    def test_range_mapping(self):
+        m = RangeMapping(['10-20', '1-10', '30-40'], '-')
+        self.assertEqual(list(m.indices([1, 9, 10, 19, 20, 25, 39, 40, np.nan, 0])), [0, 0, 1, 1, -1, -1, 2, -1, -1, -1])
+        self.assertEqual(m[15], '10-20')
+        self.assertIn(30, m)
+        self.assertNotIn(25, m)
+        with self.assertRaises(KeyError):
+            m.map([1, 25])
+        with self.assertRaises(ValueError):
+            RangeMapping(['1-10', '5-15'], '-')
     def test_set_attacker_condition_fields_values_map_f_1(self):
         a_i = pd.read_csv(ATTACKERFILE1, header=0, index_col=None, sep=',')
         ds = Dataset(source='file', dfile=DATAFILE)
@@ -92,4 +125,86 @@ class TestRisk(unittest.TestCase):
         self.assertEqual(a['age'][63], '50-64')
         self.assertEqual(a['age'][64], '64-121')
         self.assertEqual(a['age'][119], '64-121')
-
+    def test_get_condition_group_ids_1(self):
+        attacker1_df = pd.read_csv(ATTACKERFILE1, header=0, index_col=None, sep=',')
+        attacker1 = Attacker(attacker1_df)
+        ds = Dataset(source='file', dfile=DATAFILE)
+        a_known_f_m = {'RACE':'race','GENDER':'gender','STATE':'state','AGE':'age'}
+        a_c_f_m = {'RACE':'race','GENDER':'gender'}
+        a_c_f_v_m_i = {'RACE':['use_dict', RACE_DICT],'GENDER':['use_dict', GENDER_DICT]}
+        r = Risk(ds, attacker1_df, attacker1, a_known_f_m, a_c_f_m, a_c_f_v_m_i)
+        group_ids, keys = r.get_condition_group_ids()
+        self.assertEqual(len(group_ids), ds.dset.shape[0])
+        for i in range(ds.dset.shape[0]):
+            row = ds.dset.iloc[i]
+            self.assertEqual(keys[group_ids[i]], (RACE_DICT[row['race']], GENDER_DICT[row['gender']]))
+        for key in keys:
+            self.assertIn(key, attacker1.model)
+    def test_get_condition_group_ids_2(self):
+        attacker1_df = pd.read_csv(ATTACKERFILE1, header=0, index_col=None, sep=',')
+        attacker2_df = pd.read_csv(ATTACKERFILE2, header=0, index_col=None, sep=',')
+        attacker1 = Attacker(attacker1_df)
+        attacker2 = Attacker(attacker2_df)
+        ds = Dataset(source='file', dfile=DATAFILE)
+        a_known_f_m = [{'RACE':'race','GENDER':'gender','STATE':'state','AGE':'age'}, {'AGE':'age'}]
+        a_c_f_m = [{'RACE':'race','GENDER':'gender'}, {'AGE_RANGE':'age'}]
+        a_c_f_v_m_i = [{'RACE':['use_dict', RACE_DICT],'GENDER':['use_dict', GENDER_DICT]},
+                       {'AGE_RANGE':['use_range', None, '-']}]
+        nested = Risk(ds, [attacker1_df, attacker2_df], attacker1 + attacker2, a_known_f_m, a_c_f_m, a_c_f_v_m_i)
+        flat = Risk(ds, [attacker1_df, attacker2_df], Attacker.combine([attacker1, attacker2]),
+                    a_known_f_m, a_c_f_m, a_c_f_v_m_i)
+        nested_ids, nested_keys = nested.get_condition_group_ids()
+        flat_ids, flat_keys = flat.get_condition_group_ids()
+        self.assertEqual(list(nested_ids), list(flat_ids))
+        for i in [0, 3, 7]:
+            row = ds.dset.iloc[i]
+            key1 = (RACE_DICT[row['race']], GENDER_DICT[row['gender']])
+            key2 = (nested.attacker_condition_fields_values_map[1]['age'][row['age']],)
+            self.assertEqual(nested_keys[nested_ids[i]], (key1, key2))
+            self.assertEqual(flat_keys[flat_ids[i]], key1 + key2)
+        for key in nested_keys:
+            self.assertIn(key, nested.attacker.model)
+    def test_risk_metric(self):
+        ds = Dataset(source='dataframe', dset=pd.DataFrame({'race':['a','a','a','b'], 'age':[1,1,2,2]}))
+        attacker_df = pd.DataFrame({'known_fields':['RACE','AGE'], 'probability':[0.5,0.2]})
+        attacker = Attacker(attacker_df)
+        r = Risk(ds, attacker_df, attacker, {'RACE':'race','AGE':'age'}, group_size_cache=GroupSizeCache())
+        risk = r.risk_metric(per_row=True)
+        expected = [0.4/4 + 0.4/3 + 0.1/2 + 0.1/2, 0.4/4 + 0.4/3 + 0.1/2 + 0.1/2,
+                    0.4/4 + 0.4/3 + 0.1/2 + 0.1/1, 0.4/4 + 0.4/1 + 0.1/2 + 0.1/1]
+        self.assertEqual(np.allclose(risk, expected), True)
+        self.assertAlmostEqual(r.risk_metric('prosecutor'), max(expected))
+        self.assertAlmostEqual(r.risk_metric('journalist', sampling_fraction=0.5), 0.5 * max(expected))
+        self.assertAlmostEqual(r.risk_metric('marketer', sampling_fraction=0.5), 0.5 * np.mean(expected))
+        table = r.get_encoded_table()
+        for fields in [[], ['race'], ['age'], ['age','race']]:
+            self.assertIn((table, fields), r.group_size_cache)
+        self.assertEqual(r.group_size_cache.cache_info()['misses'], 4)
+        with self.assertRaises(ValueError):
+            r.risk_metric('unknown')
+    def test_risk_metric_condition_groups(self):
+        ds = Dataset(source='dataframe', dset=pd.DataFrame({'race':['a','a','a','b'], 'age':[1,1,2,2]}))
+        attacker_df = pd.DataFrame({'RACE':['a','a'], 'known_fields':['AGE','RACE'], 'probability':[0.5,1.0]})
+        attacker = Attacker(attacker_df)
+        r = Risk(ds, attacker_df, attacker, {'RACE':'race','AGE':'age'}, {'RACE':'race'}, {'RACE':['exact']})
+        risk = r.risk_metric(per_row=True)
+        # the rows of race b have no model, the attacker does not know any of their fields
+        expected = [0.5/3 + 0.5/2, 0.5/3 + 0.5/2, 0.5/3 + 0.5/1, 1/4]
+        self.assertEqual(np.allclose(risk, expected), True)
+    def test_risk_metric_factorized(self):
+        ds = Dataset(source='file', dfile=DATAFILE)
+        fields = ['race', 'gender', 'state', 'age']
+        attacker_df = pd.DataFrame({'known_fields': ['%s%d,OTHER%d' % (fields[i % 4].upper(), i, i) for i in range(40)],
+                                    'probability': [0.01 * (i % 20) for i in range(40)]})
+        a_known_f_m = {'%s%d' % (fields[i % 4].upper(), i): fields[i % 4] for i in range(40)}
+        factorized = Attacker(attacker_df, factorized=True)
+        r = Risk(ds, attacker_df, factorized, a_known_f_m, group_size_cache=GroupSizeCache())
+        risk = r.risk_metric(per_row=True)
+        # the 40 factors are never enumerated
+        self.assertIsNone(factorized.model._expanded)
+        small_df = attacker_df.iloc[:10]
+        expected = Risk(ds, small_df, Attacker(small_df), a_known_f_m).risk_metric(per_row=True)
+        small = Risk(ds, small_df, Attacker(small_df, factorized=True), a_known_f_m).risk_metric(per_row=True)
+        self.assertEqual(np.allclose(small, expected), True)
+        self.assertEqual(len(risk), ds.dset.shape[0])
+        self.assertEqual(bool(np.all((risk > 0) & (risk <= 1))), True)
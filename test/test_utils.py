@@ -11,3 +11,10 @@ class TestUtils(unittest.TestCase):
         expected_array = np.array([[0, 0, 0, 0],[0, 0, 0, 1],[0, 0, 1, 0],[0, 0, 1, 1],[0, 1, 0, 0],[0, 1, 0, 1],[0, 1, 1, 0],[0, 1, 1, 1],[1, 0, 0, 0],[1, 0, 0, 1],[1, 0, 1, 0],[1, 0, 1, 1],[1, 1, 0, 0],[1, 1, 0, 1],[1, 1, 1, 0],[1, 1, 1, 1]])
         self.assertEqual(convert_2d_array_to_set(binary_array), convert_2d_array_to_set(expected_array))
 
+
+    def test_binary_array_generation_cached(self):
+        binary_array = generate_all_binary_string(3)
+        self.assertEqual(binary_array.dtype, np.uint8)
+        self.assertEqual(binary_array[5].tolist(), [1, 0, 1])
+        self.assertFalse(binary_array.flags.writeable)
+        self.assertIs(generate_all_binary_string(3), binary_array)